@@ -0,0 +1,97 @@
+#!bin/python
+"""
+Compares the ElementTree Accessor with its previous
+version, which searched children on every attribute access.
+
+Usage: bin/python benchmarks/accessor.py [iterations]
+"""
+
+import base64
+import sys
+import time
+
+from xml.etree import cElementTree as ET
+
+from microblog.et_accessor import Accessor
+
+
+class LegacyAccessor(object):
+    """Accessor, as it was before the children index."""
+
+    def __init__(self, xml):
+        self.xml = xml
+
+    def __getattribute__(self, name):
+        if name == 'xml':
+            return object.__getattribute__(self, name)
+
+        self_tag = self.xml.tag
+        if self_tag[0] == '{':
+            el_name = self_tag[:self_tag.rfind('}') + 1] + name
+        else:
+            el_name = name
+
+        elements = self.xml.findall(el_name)
+        l = len(elements)
+        if l == 1:
+            return LegacyAccessor(elements[0])
+        elif l > 1:
+            return map(LegacyAccessor, elements)
+
+        if self.xml.attrib.has_key(name):
+            return self.xml.attrib[name]
+
+        if hasattr(self.xml, name):
+            return getattr(self.xml, name)
+        return ''
+
+
+VCARD = '''<vCard xmlns="vcard-temp">
+    <FN>John Smith</FN>
+    <N><FAMILY>Smith</FAMILY><GIVEN>John</GIVEN></N>
+    <NICKNAME>john</NICKNAME>
+    <URL>http://example.com/</URL>
+    <BDAY>1970-01-01</BDAY>
+    <ORG><ORGNAME>Example</ORGNAME><ORGUNIT>R&amp;D</ORGUNIT></ORG>
+    <TITLE>Engineer</TITLE>
+    <TEL><WORK/><VOICE/><NUMBER>+1 555 0100</NUMBER></TEL>
+    <TEL><HOME/><VOICE/><NUMBER>+1 555 0101</NUMBER></TEL>
+    <EMAIL><INTERNET/><PREF/><USERID>john@example.com</USERID></EMAIL>
+    <ADR><WORK/><LOCALITY>Springfield</LOCALITY><CTRY>USA</CTRY></ADR>
+    <PHOTO><TYPE>image/jpeg</TYPE><BINVAL>%s</BINVAL></PHOTO>
+</vCard>''' % base64.encodestring('\xff' * 8192)
+
+
+def read_template(vcard):
+    """Attributes, which user.html and the avatar handler used to read."""
+    if vcard.PHOTO:
+        vcard.PHOTO.BINVAL.text
+        vcard.PHOTO.TYPE
+    unicode(vcard.FN)
+    unicode(vcard.NICKNAME)
+    vcard.TEL[1].NUMBER.text
+
+
+def measure(cls, xml, iterations, reuse):
+    vcard = cls(xml)
+    started = time.time()
+    for i in xrange(iterations):
+        if not reuse:
+            vcard = cls(xml)
+        read_template(vcard)
+    return iterations / (time.time() - started)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    xml = ET.fromstring(VCARD)
+
+    print '%-20s %14s %14s %10s' % ('case', 'legacy, op/s', 'accessor, op/s', 'speedup')
+    for title, reuse in (('new wrapper', False), ('same wrapper', True)):
+        legacy = measure(LegacyAccessor, xml, iterations, reuse)
+        current = measure(Accessor, xml, iterations, reuse)
+        print '%-20s %14.0f %14.0f %9.1fx' % (title, legacy, current, current / legacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Synthetic corpora for the benchmarks.
+
+Words are drawn from a fixed vocabulary with Zipfian
+distribution, like words in real messages: a few words
+are very frequent and most of them are rare.
+"""
+
+import random
+
+from bisect import bisect_left
+from matcher import random_word
+
+
+class Corpus(object):
+    def __init__(self, vocabulary_size=50000, exponent=1.1, seed=42):
+        self.random = random.Random(seed)
+
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add(random_word(self.random))
+        self.words = list(words)
+
+        self._cumulative = []
+        total = 0.0
+        for rank in xrange(1, vocabulary_size + 1):
+            total += 1.0 / rank ** exponent
+            self._cumulative.append(total)
+        self._total = total
+
+    def word(self):
+        idx = bisect_left(self._cumulative, self.random.random() * self._total)
+        return self.words[min(idx, len(self.words) - 1)]
+
+    def rare_word(self):
+        """Returns a word from the less frequent half of the vocabulary.
+
+        Most people search for specific words, not for "the" or "and".
+        """
+        return self.random.choice(self.words[len(self.words) // 2:])
+
+    def terms(self, count, max_words=3):
+        """Returns 'count' unique search phrases."""
+        terms = set()
+        while len(terms) < count:
+            words = [self.rare_word()]
+            words.extend(self.word() for i in xrange(self.random.randint(0, max_words - 1)))
+            terms.add(u' '.join(words))
+        return list(terms)
+
+    def messages(self, count, min_words=5, max_words=30):
+        return [
+            u' '.join(
+                self.word()
+                for j in xrange(self.random.randint(min_words, max_words))
+            )
+            for i in xrange(count)
+        ]
@@ -0,0 +1,109 @@
+#!bin/python
+"""
+Compares live search matching of the SearchCache
+with the old loop over all saved phrases.
+
+Usage: bin/python benchmarks/matcher.py [num_messages]
+"""
+
+import random
+import sys
+import time
+
+from microblog.search import SearchCache
+
+
+SIZES = (1000, 10000, 100000)
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def random_word(rnd, min_len=3, max_len=10):
+    return ''.join(
+        rnd.choice(ALPHABET)
+        for i in xrange(rnd.randint(min_len, max_len))
+    )
+
+
+def make_terms(rnd, count):
+    terms = set()
+    while len(terms) < count:
+        terms.add(' '.join(
+            random_word(rnd) for i in xrange(rnd.randint(1, 3))
+        ))
+    return list(terms)
+
+
+def make_messages(rnd, terms, count, words_per_message=20):
+    messages = []
+    for i in xrange(count):
+        words = [random_word(rnd) for j in xrange(words_per_message)]
+        # some messages should match something
+        if i % 3 == 0:
+            words.append(rnd.choice(terms))
+        messages.append(' '.join(words))
+    return messages
+
+
+def legacy_match(searches, text):
+    """Matching, as it was done before SearchCache.match.
+
+    'searches' is a dict phrase -> (words, set of usernames).
+    """
+    def all_in_text(words, text):
+        return all(map(lambda word: word in text, words))
+
+    terms = {}
+    for words, users in searches.itervalues():
+        if all_in_text(words, text):
+            for user in users:
+                terms[user] = words
+    return terms
+
+
+def measure(func, searches, messages):
+    started = time.time()
+    for text in messages:
+        func(searches, text)
+    return time.time() - started
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rnd = random.Random(42)
+
+    print '%10s %14s %14s %14s %10s' % (
+        'terms', 'build, s', 'legacy, msg/s', 'matcher, msg/s', 'speedup')
+
+    for size in SIZES:
+        terms = make_terms(rnd, size)
+        messages = make_messages(rnd, terms, num_messages)
+
+        rows = [(term, 'user%d' % (idx % 5000)) for idx, term in enumerate(terms)]
+
+        searches = SearchCache()
+        searches.apply(('+', term, username) for term, username in rows)
+
+        legacy_searches = {}
+        for term, username in rows:
+            legacy_searches.setdefault(
+                term, (tuple(term.split()), set())
+            )[1].add(username)
+
+        started = time.time()
+        searches.match('')
+        build_time = time.time() - started
+
+        legacy = measure(legacy_match, legacy_searches, messages)
+        matcher = measure(SearchCache.match, searches, messages)
+
+        print '%10d %14.3f %14.1f %14.1f %9.1fx' % (
+            size,
+            build_time,
+            num_messages / legacy,
+            num_messages / matcher,
+            legacy / matcher,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!bin/python
+"""
+Compares memory, used by the SearchCache, with the old
+structure: dict phrase -> (tuple of words, set of usernames).
+
+Usage: bin/python benchmarks/memory.py [num_rows]
+"""
+
+import random
+import sys
+
+from array import array
+from microblog.search import SearchCache
+
+from matcher import make_terms
+
+
+def deep_sizeof(obj, seen=None):
+    """Returns approximate size of the object with everything it refers to."""
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif isinstance(obj, (basestring, int, long, float, array)):
+        pass
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+
+def make_rows(rnd, num_rows, users_per_term=10):
+    """Returns rows (term, username), like they come from the search_terms table."""
+    terms = make_terms(rnd, num_rows // users_per_term)
+    num_users = max(1, num_rows // 20)
+    rows = []
+    for term in terms:
+        for i in xrange(users_per_term):
+            # a new string object for every row, as ORM does
+            username = u'user%d' % rnd.randint(0, num_users)
+            rows.append((unicode(term), username))
+    return rows
+
+
+def main():
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rnd = random.Random(42)
+    rows = make_rows(rnd, num_rows)
+
+    legacy = {}
+    for term, username in rows:
+        legacy.setdefault(
+            term, (tuple(term.split()), set())
+        )[1].add(username)
+
+    searches = SearchCache()
+    searches.apply(('+', term, username) for term, username in rows)
+
+    legacy_size = deep_sizeof(legacy)
+
+    searches_size = deep_sizeof(searches)
+    searches.match(u'')
+    automaton_size = deep_sizeof(searches._version.automaton)
+
+    print 'rows:                 %d' % len(rows)
+    print 'phrases:              %d' % len(searches)
+    print 'legacy structure:     %.1f MB' % (legacy_size / 1048576.0)
+    print 'SearchCache:          %.1f MB (%.1fx smaller)' % (
+        searches_size / 1048576.0, float(legacy_size) / searches_size)
+    print 'automaton:            %.1f MB' % (automaton_size / 1048576.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!bin/python
+"""
+Stress test for the SearchCache: several threads add and remove
+search terms, while others match messages and iterate over the cache.
+
+Every match is done on a frozen version of the cache and compared
+with a brute force search over the same version, so any inconsistency
+between the index, the automaton and the terms is reported.
+
+Usage: bin/python benchmarks/stress.py [seconds]
+"""
+
+import random
+import sys
+import threading
+import time
+import traceback
+
+from microblog.search import SearchCache
+
+from matcher import random_word
+
+
+NUM_WRITERS = 2
+NUM_READERS = 2
+
+
+def brute_force(searches, text):
+    result = {}
+    for phrase, (words, users) in searches.iteritems():
+        if all(word in text for word in words):
+            for username in users:
+                result.setdefault(username, set()).update(words)
+    return result
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    rnd = random.Random(42)
+
+    vocabulary = [random_word(rnd, 2, 6) for i in xrange(500)]
+    usernames = ['user%d' % i for i in xrange(200)]
+
+    def random_phrase(rnd):
+        return ' '.join(rnd.choice(vocabulary) for i in xrange(rnd.randint(1, 2)))
+
+    searches = SearchCache(rebuild_delay=0.01)
+    searches.apply(
+        ('+', random_phrase(rnd), rnd.choice(usernames))
+        for i in xrange(2000)
+    )
+
+    deadline = time.time() + duration
+    errors = []
+    counters = dict(changes=0, matches=0, iterations=0)
+
+    def writer(seed):
+        rnd = random.Random(seed)
+        while time.time() < deadline and not errors:
+            changes = [
+                (rnd.choice('+-'), random_phrase(rnd), rnd.choice(usernames))
+                for i in xrange(rnd.randint(1, 10))
+            ]
+            try:
+                searches.apply(changes)
+            except Exception:
+                errors.append(traceback.format_exc())
+            counters['changes'] += len(changes)
+
+    def reader(seed):
+        rnd = random.Random(seed)
+        while time.time() < deadline and not errors:
+            text = ' '.join(rnd.choice(vocabulary) for i in xrange(20))
+            try:
+                frozen = searches.freeze()
+                result = dict(
+                    (username, set(words))
+                    for username, words in frozen.match(text).iteritems()
+                )
+                expected = brute_force(frozen, text)
+                if result != expected:
+                    errors.append('Mismatch for "%s":\n%r\n%r' % (text, result, expected))
+
+                # live cache should be iterable during changes
+                for phrase, (words, users) in searches.iteritems():
+                    len(users)
+                searches.count_rows()
+            except Exception:
+                errors.append(traceback.format_exc())
+            counters['matches'] += 1
+            counters['iterations'] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in xrange(NUM_WRITERS)]
+    threads += [threading.Thread(target=reader, args=(100 + i,)) for i in xrange(NUM_READERS)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print 'changes: %(changes)d, matches: %(matches)d' % counters
+    print 'phrases at the end: %d' % len(searches)
+
+    if errors:
+        print '%d errors, first one:' % len(errors)
+        print errors[0]
+        sys.exit(1)
+    print 'OK'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!bin/python
+"""
+Offline benchmark suite for the live search.
+
+Generates search terms and messages with Zipfian word distribution,
+loads terms into an in-memory SQLite database and drives both the
+SearchCache matching and the whole search._process_event with a stub
+bot, which only counts sent messages.
+
+Usage: bin/python benchmarks/suite.py --help
+"""
+
+import optparse
+import resource
+import time
+
+from sqlalchemy import create_engine
+
+from microblog import search
+from microblog.db import Session
+from microblog.models import Base, User, SearchTerm, subscribers_t
+from microblog.stats import Latency
+
+from corpus import Corpus
+from memory import deep_sizeof
+
+
+class StubBot(object):
+    jid = 'microblog.example.com'
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, mto, mbody, **kwargs):
+        self.sent += 1
+
+    def send_bulk(self, mtos, mbody, **kwargs):
+        self.sent += len(mtos)
+
+
+class StubFrom(object):
+    def __init__(self, jid):
+        self.jid = jid
+
+
+class StubPayload(object):
+    def fork(self, name, values):
+        return list(values)
+
+
+class StubEvent(dict):
+    """Looks like sleekxmpp's message for the search module."""
+
+    payload = StubPayload()
+
+    def __init__(self, jid, body):
+        super(StubEvent, self).__init__()
+        self['from'] = StubFrom(jid)
+        self['body'] = body
+
+    def getType(self):
+        return 'chat'
+
+
+def setup_database(corpus, options):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+
+    usernames = [u'user%d' % i for i in xrange(options.users)]
+    rnd = corpus.random
+
+    connection = engine.connect()
+    connection.execute(User.__table__.insert(), [
+        dict(username=username, jid=username + u'@example.com')
+        for username in usernames
+    ])
+
+    subscribers = set()
+    for username in usernames:
+        for i in xrange(options.followers):
+            subscriber = rnd.choice(usernames)
+            if subscriber != username:
+                subscribers.add((username, subscriber))
+    connection.execute(subscribers_t.insert(), [
+        dict(user=user, subscriber=subscriber)
+        for user, subscriber in subscribers
+    ])
+
+    terms = corpus.terms(options.terms)
+    rows = set()
+    for term in terms:
+        for i in xrange(options.users_per_term):
+            rows.add((term, rnd.choice(usernames)))
+    connection.execute(SearchTerm.__table__.insert(), [
+        dict(term=term, username=username)
+        for term, username in rows
+    ])
+    connection.close()
+
+    return usernames, len(rows)
+
+
+def run(name, func, items):
+    latency = Latency(window=len(items))
+
+    started = time.time()
+    for item in items:
+        item_started = time.time()
+        func(item)
+        latency.add(time.time() - item_started)
+    elapsed = time.time() - started
+
+    stats = latency.as_dict()
+    print '%-16s %10.1f %10.3f %10.3f %10.3f' % (
+        name,
+        len(items) / elapsed,
+        stats['p50'] * 1000,
+        stats['p99'] * 1000,
+        stats['max'] * 1000,
+    )
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--terms', type='int', default=10000,
+        help='number of distinct search phrases')
+    parser.add_option('--users-per-term', type='int', default=5,
+        help='how many users watch each phrase')
+    parser.add_option('--users', type='int', default=5000)
+    parser.add_option('--followers', type='int', default=20,
+        help='followers of each user')
+    parser.add_option('--messages', type='int', default=1000)
+    parser.add_option('--vocabulary', type='int', default=50000)
+    parser.add_option('--exponent', type='float', default=1.1,
+        help='exponent of the Zipfian distribution')
+    parser.add_option('--workers', type='int', default=0,
+        help='number of search processes')
+    parser.add_option('--seed', type='int', default=42)
+    options, args = parser.parse_args()
+
+    corpus = Corpus(options.vocabulary, options.exponent, options.seed)
+    usernames, num_rows = setup_database(corpus, options)
+    messages = corpus.messages(options.messages)
+
+    started = time.time()
+    search._searches = search._load_terms()
+    load_time = time.time() - started
+
+    if options.workers:
+        search._pool = search.SearchPool(search._searches, options.workers)
+
+    try:
+        print 'search terms: %d phrases, %d rows, loaded in %.2f s' % (
+            len(search._searches), num_rows, load_time)
+        print 'cache size: %.1f MB' % (deep_sizeof(search._searches) / 1048576.0)
+
+        # builds the automaton
+        started = time.time()
+        search._match(u'')
+        print 'automaton built in %.2f s' % (time.time() - started)
+        print
+
+        print '%-16s %10s %10s %10s %10s' % (
+            'benchmark', 'msg/s', 'p50, ms', 'p99, ms', 'max, ms')
+
+        run('match', lambda text: search._match(text.lower()), messages)
+
+        bot = StubBot()
+        rnd = corpus.random
+        events = [
+            StubEvent(rnd.choice(usernames) + u'@example.com/resource', text)
+            for text in messages
+        ]
+        run('process_event', lambda event: search._process_event(bot, event), events)
+        print
+        print 'notifications sent: %d (%.1f per message)' % (
+            bot.sent, float(bot.sent) / len(events))
+    finally:
+        if search._pool is not None:
+            search._pool.stop()
+
+    print 'max RSS: %.1f MB' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Presence bootstrap, which is done after the bot has connected.
+"""
+import logging
+import threading
+import time
+
+from microblog.db import db_session
+from microblog.models import User
+
+
+class PresenceBootstrap(object):
+    """Sends presence and probe to every user in the background.
+
+    Users are read by pages of 'page_size', ordered by username,
+    each page in its own short session, and no more than 'rate'
+    users per second are processed, so the XMPP server is not
+    flooded and the bot keeps processing commands.
+
+    Along with presences, changelog is sent to users, if the bot
+    was upgraded. Last announced username is kept in the bot's
+    state, so after restart changelog goes only to the rest.
+    """
+
+    def __init__(self, bot, rate=200, page_size=500, retry_delay=5):
+        self.bot = bot
+        self.rate = rate
+        self.page_size = page_size
+        self.retry_delay = retry_delay
+        self.log = logging.getLogger('bootstrap')
+
+        self.total = 0
+        self.sent = 0
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts bootstrap from the first user.
+
+        Bootstrap, which is in progress, is stopped first.
+        """
+        self.stop()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target = self._run,
+            name = 'bootstrap',
+            args = (self._stop,),
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        started_at = self.started_at
+        finished_at = self.finished_at or time.time()
+        return dict(
+            running = self._thread is not None and self._thread.is_alive(),
+            total = self.total,
+            sent = self.sent,
+            elapsed = started_at and finished_at - started_at or 0.0,
+        )
+
+    @db_session
+    def _count(self, session=None):
+        return session.query(User).count()
+
+    @db_session
+    def _load_page(self, cursor, session=None):
+        """Returns list of (username, jid) after the 'cursor' username."""
+        query = session.query(User.username, User.jid)
+        if cursor is not None:
+            query = query.filter(User.username > cursor)
+        return query.order_by(User.username).limit(self.page_size).all()
+
+    def _run(self, stop):
+        try:
+            self._bootstrap(stop)
+        except Exception:
+            self.log.exception('Presence bootstrap failed.')
+
+    def _bootstrap(self, stop):
+        bot = self.bot
+        self.sent = 0
+        self.started_at = time.time()
+        self.finished_at = None
+
+        changes = bot._changes_message()
+        announced = changes and bot._get_announced()
+
+        # Each send is paced from the previous one, so after a stall
+        # (e.g. retries of a page load) the lost time is not caught up.
+        next_at = time.time()
+        cursor = None
+        while not stop.is_set():
+            try:
+                if cursor is None:
+                    self.total = self._count()
+                page = self._load_page(cursor)
+            except Exception:
+                self.log.exception(
+                    'Can\'t load users after %r, will retry.' % cursor
+                )
+                stop.wait(self.retry_delay)
+                continue
+
+            if not page:
+                break
+
+            for username, jid in page:
+                if self.rate:
+                    delay = next_at - time.time()
+                    if delay > 0:
+                        stop.wait(delay)
+                    next_at = max(next_at, time.time()) + 1.0 / self.rate
+                if stop.is_set():
+                    return
+
+                bot._send_presence(jid)
+                bot._send_presence_probe(jid)
+                self.sent += 1
+
+            if changes:
+                bot.send_bulk(
+                    (jid for username, jid in page
+                        if announced is None or username > announced),
+                    changes,
+                    mfrom = bot.jid,
+                    mtype = 'chat'
+                )
+                bot._set_announced(page[-1][0])
+
+            cursor = page[-1][0]
+            self.log.info(
+                'Presence was sent to %d of %d users.' % (self.sent, self.total)
+            )
+
+        if not stop.is_set():
+            self.finished_at = time.time()
+            bot._changes_sent()
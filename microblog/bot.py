@@ -1,31 +1,61 @@
 import re
+import copy
 import base64
 import logging
 import hashlib
 import datetime
+import time
 import yaml
 import os.path
 import sleekxmpp.componentxmpp
 
 from microblog import search
+from microblog.bootstrap import PresenceBootstrap
+from microblog.digest import DigestBuffer
+from microblog.presence import PresenceTracker
+from microblog.ratelimit import RateLimiter
+from microblog import vcard
 from microblog import changelog
 from microblog.db import db_session, IntegrityError
 from microblog.db_helpers import \
     get_user_by_jid, \
     get_user_by_username, \
-    get_all_users
-from microblog.exceptions import UserNotFound
+    add_subscriber, \
+    remove_subscriber, \
+    configure_user_cache, \
+    invalidate_user, \
+    user_cache_stats, \
+    set_presence, \
+    get_digest_windows
+from microblog.exceptions import RateLimited
+from microblog.graph import GRAPH
 from microblog.queue import QUEUE
-from microblog.models import SearchTerm, Tweet
-from microblog.utils import trace_methods
+from microblog.models import SearchTerm
+from microblog.stats import Latency
+from microblog.utils import trace_methods, LRUCache
+from microblog.workers import KeyedPool
+from microblog.writer import TweetWriter
 from pdb import set_trace
 from xml.etree import cElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 from collections import defaultdict
 from pkg_resources import parse_version as V
 
 __version__ = changelog.current_version()
 
 
+# Placeholder for the recipient in pre-serialized stanzas.
+_RECIPIENT = 'recipient@placeholder.invalid'
+
+_MENTION = re.compile(r'(?<!\w)@(\w+)')
+
+
+def _escape_jid(jid):
+    if isinstance(jid, unicode):
+        jid = jid.encode('utf-8')
+    return xml_escape(jid, {'"': '&quot;', "'": '&apos;'})
+
+
 class Payload(list):
     """This class helps to extend cleartext's stanzas."""
 
@@ -48,20 +78,10 @@ class Payload(list):
         for node in self:
             if node.tag == '{http://cleartext.net/mblog}x':
                 return node.find('{http://cleartext.net/mblog}buddy')
-        # node not found, create one
-        ns = '{http://cleartext.net/mblog}'
-        user = get_user_by_jid(self._event['from'].jid, self._session)
-        avatar_hash = self._bot.users[user.username].get('photo', '')
-
-        x_e = ET.Element(ns + 'x')
-        buddy_e = ET.SubElement(x_e, 'buddy', type='sender')
-        ET.SubElement(buddy_e, 'displayName').text = \
-            user.vcard and unicode(user.vcard.NICKNAME) \
-            or user.username
-        ET.SubElement(buddy_e, 'userName').text = user.username
-        ET.SubElement(buddy_e, 'jid').text = user.jid
-        ET.SubElement(buddy_e, 'avatar', type='hash').text = avatar_hash
-        ET.SubElement(buddy_e, 'serviceJid').text = self._bot.jid
+        # node not found, clone sender's template
+        template = self._bot._buddy_template(self._event['from'].jid, self._session)
+        x_e = copy.copy(template)
+        buddy_e = x_e[0] = copy.copy(template[0])
         self.append(x_e)
         return buddy_e
 
@@ -90,6 +110,34 @@ class Payload(list):
             if text is not None:
                 el.text = text
 
+    def fork(self, name, values):
+        """Returns payload's copy with additional nodes in the buddy node.
+
+        Only 'x' and 'buddy' nodes are copied, all other elements
+        are shared with this payload, so it is much cheaper
+        than a deepcopy and could be done for every recipient.
+        """
+        buddy = self._find_buddy_node()
+        if buddy is None:
+            return list(self)
+
+        result = list(self)
+        for idx, node in enumerate(result):
+            if node.tag == '{http://cleartext.net/mblog}x':
+                break
+
+        x = copy.copy(node)
+        new_buddy = copy.copy(buddy)
+        x[list(x).index(buddy)] = new_buddy
+
+        for text in values:
+            el = new_buddy.makeelement('{http://cleartext.net/mblog}' + name, {})
+            el.text = text
+            new_buddy.append(el)
+
+        result[idx] = x
+        return result
+
 
 class Commands(object):
     """Mixin with commands."""
@@ -97,11 +145,9 @@ class Commands(object):
     def _show_followers(self, event, session=None):
         user = get_user_by_jid(event['from'].jid, session)
         if user:
-            followers = list(user.subscribers)
+            followers = sorted(GRAPH.subscribers(user.username, session))
             if followers:
-                body = 'Your followers are:\n' + '\n'.join(
-                    f.username for f in followers
-                )
+                body = 'Your followers are:\n' + '\n'.join(followers)
             else:
                 body = 'You have no followers.'
             self.xmpp.sendMessage(user.jid, body, mfrom=self.jid, mtype='chat')
@@ -109,11 +155,9 @@ class Commands(object):
     def _show_contacts(self, event, session=None):
         user = get_user_by_jid(event['from'].jid, session)
         if user:
-            contacts = list(user.contacts)
+            contacts = sorted(GRAPH.contacts(user.username, session))
             if contacts:
-                body = 'Your contacts are:\n' + '\n'.join(
-                    f.username for f in contacts
-                )
+                body = 'Your contacts are:\n' + '\n'.join(contacts)
             else:
                 body = 'You have no contacts.'
             self.xmpp.sendMessage(user.jid, body, mfrom=self.jid, mtype='chat')
@@ -127,23 +171,24 @@ class Commands(object):
             self.xmpp.sendMessage(event['from'].jid, body, mfrom=self.jid, mtype='chat')
             return
 
-        for idx, u in enumerate(user.contacts):
-            if u.username == contact.username:
-                user.contacts.pop(idx)
-                session.commit()
-                self.xmpp.sendMessage(
-                    user.jid,
-                    'You don\'t follow @%s anymore.' % username,
-                    mfrom = self.jid,
-                    mtype = 'chat'
-                )
-                self.xmpp.sendMessage(
-                    contact.jid,
-                    'You lost one of your followers: @%s.' % user.username,
-                    mfrom = self.jid,
-                    mtype = 'chat'
-                )
-                return
+        if contact.username in GRAPH.contacts(user.username, session):
+            remove_subscriber(contact.username, user.username, session)
+            session.commit()
+            GRAPH.unfollow(user.username, contact.username)
+
+            self.xmpp.sendMessage(
+                user.jid,
+                'You don\'t follow @%s anymore.' % username,
+                mfrom = self.jid,
+                mtype = 'chat'
+            )
+            self.xmpp.sendMessage(
+                contact.jid,
+                'You lost one of your followers: @%s.' % user.username,
+                mfrom = self.jid,
+                mtype = 'chat'
+            )
+            return
 
         self.xmpp.sendMessage(
             user.jid,
@@ -166,7 +211,7 @@ class Commands(object):
             self.xmpp.sendMessage(event['from'].jid, body, mfrom=self.jid, mtype='chat')
             return
 
-        if contact in user.contacts:
+        if contact.username in GRAPH.contacts(user.username, session):
             self.xmpp.sendMessage(
                 user.jid,
                 'You already follow @%s.' % username,
@@ -175,8 +220,9 @@ class Commands(object):
             )
             return
 
-        user.contacts.append(contact)
+        add_subscriber(contact.username, user.username, session)
         session.commit()
+        GRAPH.follow(user.username, contact.username)
 
         self.xmpp.sendMessage(
             user.jid,
@@ -204,10 +250,10 @@ class Commands(object):
 
         if user:
             body = 'Direct message from @%s: %s' % (from_.username, message)
-            self.send_message(user.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+            self._send_in_order(from_.username, user.jid, body, event.payload)
         else:
             body = 'User @%s not found.' % username
-            self.send_message(from_.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+            self._send_in_order(from_.username, from_.jid, body, event.payload)
 
     def _reply_message(self, event, username, message, session=None):
         user = get_user_by_username(username, session)
@@ -215,16 +261,22 @@ class Commands(object):
 
         if user:
             body = 'Reply from @%s: %s' % (from_.username, message)
-            self.send_message(user.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+            self._send_in_order(from_.username, user.jid, body, event.payload)
         else:
             body = 'User @%s not found.' % username
-            self.send_message(from_.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+            self._send_in_order(from_.username, from_.jid, body, event.payload)
 
     def _add_search(self, event, word, session=None):
         user = get_user_by_jid(event['from'].jid, session)
+        jid = user.jid
         try:
-            neightbours = search.add_search(word, user.username, max_neightbours=21)
+            # term is saved in this session, not in a new one
+            neightbours = search.add_search(
+                word, user.username, max_neightbours=21, session=session
+            )
+            session.commit()
         except IntegrityError:
+            session.rollback()
             message = 'You already watching for these terms.'
         else:
             message = 'Now you are looking for "%s" in all messages.' % word
@@ -235,7 +287,7 @@ class Commands(object):
                     message += '\nand more...'
 
         self.xmpp.sendMessage(
-            user.jid,
+            jid,
             message,
             mfrom = self.jid,
             mtype = 'chat'
@@ -243,7 +295,7 @@ class Commands(object):
 
     def _remove_search(self, event, word, session=None):
         user = get_user_by_jid(event['from'].jid, session)
-        search.remove_search(word, user.username)
+        search.remove_search(word, user.username, session=session)
         self.xmpp.sendMessage(user.jid, 'Search on "%s" was dropped' % word, mfrom=self.jid, mtype='chat')
 
     def _show_searches(self, event, session=None):
@@ -258,6 +310,28 @@ class Commands(object):
             body = 'You have no searches.'
         self.xmpp.sendMessage(user.jid, body, mfrom=self.jid, mtype='chat')
 
+    def _digest(self, event, value=None, session=None):
+        user = get_user_by_jid(event['from'].jid, session)
+
+        if value is not None:
+            minutes = value.lower() != 'off' and int(value) or 0
+            if minutes > self.max_digest_window:
+                body = 'Digest window could not be longer than %d minutes.' % self.max_digest_window
+                self.xmpp.sendMessage(user.jid, body, mfrom=self.jid, mtype='chat')
+                return
+
+            user.digest = minutes
+            session.commit()
+            invalidate_user(username=user.username)
+            self._digests.set_window(user.jid, minutes * 60)
+
+        minutes = self._digests.get_window(user.jid) // 60
+        if minutes:
+            body = 'You receive digests of notifications every %d minutes.' % minutes
+        else:
+            body = 'Digest mode is off, you receive every notification.'
+        self.xmpp.sendMessage(user.jid, body, mfrom=self.jid, mtype='chat')
+
     def _show_help(self, event, session=None):
         user = get_user_by_jid(event['from'].jid, session)
 
@@ -274,6 +348,7 @@ class Commands(object):
         (r'^s$', _show_searches, '"s" - show saved searches'),
         (r'^s (?P<word>.+)$', _add_search, '"s word" - save live search term'),
         (r'^us (?P<word>.+)$', _remove_search, '"us word" - delete live search term'),
+        (r'^digest(?: (?P<value>\d+|off))?$', _digest, '"digest minutes" - get notifications in one message every few minutes, "digest off" - one message for each notification'),
         (r'^help$', _show_help, '"help" - show this help'),
     ]
 
@@ -295,12 +370,47 @@ class Commands(object):
         for regex, func, help in self._COMMANDS:
             match = regex.match(message)
             if match is not None:
-                func(self, event, session=session, **match.groupdict())
+                started = time.time()
+                try:
+                    func(self, event, session=session, **match.groupdict())
+                finally:
+                    self.command_latency[_command_name(func)].add(
+                        time.time() - started
+                    )
                 return True
 
         return False
 
 
+def _command_name(func):
+    return func.__name__.lstrip('_')
+
+
+def db_sessions_needed(dispatch_workers=4, delivery_workers=2,
+                       tweet_flush_rows=0, **kwargs):
+    """Returns how many database sessions the bot and
+    the frontend could hold at once with the given settings.
+
+    Arguments are the same as Bot's, others are ignored.
+    """
+    # Pools of zero size run tasks in the caller's thread,
+    # and a delivery task opens a session inside the caller's one.
+    dispatchers = max(dispatch_workers, 1)
+    sessions = (
+        dispatchers
+        + (delivery_workers or dispatchers)
+        + 1 # search thread
+        + 1 # search terms reload
+        + 1 # presence bootstrap
+        + 1 # frontend
+        # tweet writer or, without it, dispatchers' own inserts
+        + (tweet_flush_rows and 1 or dispatchers)
+    )
+    if dispatch_workers and not delivery_workers:
+        sessions += 1 # presences are saved in the XMPP thread
+    return sessions
+
+
 class ComponentXMPP(sleekxmpp.componentxmpp.ComponentXMPP):
     """Wrapper around sleekxmpp's component.
 
@@ -321,7 +431,34 @@ class Bot(Commands):
                  firstname = 'Cleartext Microblogging',
                  avatar = 'data/avatar.jpg',
                  max_tweet_length = None,
+                 search_workers = 0,
+                 search_queue_size = 0,
+                 search_queue_policy = 'block',
+                 search_snapshot = None,
+                 search_snapshot_max_age = 86400,
+                 delivery_workers = 2,
+                 dispatch_workers = 4,
+                 user_cache_size = 10000,
+                 user_cache_ttl = 300,
+                 presence_rate = 200,
+                 presence_page_size = 500,
+                 tweet_flush_rows = 0,
+                 tweet_flush_delay = 0.005,
+                 spool_limit = 0,
+                 spool_digest = 10,
+                 max_digest_window = 1440,
+                 rate_limit_user = 0,
+                 rate_limit_user_burst = 10,
+                 rate_limit_global = 0,
+                 rate_limit_global_burst = 100,
         ):
+        # Search processes are forked before any thread is started.
+        search.load(
+            workers = search_workers,
+            snapshot_file = search_snapshot,
+            snapshot_max_age = search_snapshot_max_age,
+        )
+
         QUEUE.set_bot(self)
         self.users = defaultdict(dict) # Cache for some user's info
         self._load_state()
@@ -340,8 +477,9 @@ class Bot(Commands):
 
         self.xmpp.add_event_handler('message', self._handle_message)
 
-        for event in ['got_online', 'got_offline', 'changed_status']:
-            self.xmpp.add_event_handler(event, self._handle_status_change)
+        self.xmpp.add_event_handler('got_online', self._handle_got_online)
+        self.xmpp.add_event_handler('got_offline', self._handle_got_offline)
+        self.xmpp.add_event_handler('changed_status', self._handle_status_change)
 
         self.xmpp.add_event_handler('get_vcard', self._handle_get_vcard)
 
@@ -364,6 +502,46 @@ class Bot(Commands):
         self.firstname = firstname
         self.avatar = avatar
         self.max_tweet_length = max_tweet_length
+        self.search_workers = search_workers
+        self.search_queue_size = search_queue_size
+        self.search_queue_policy = search_queue_policy
+        self.search_snapshot = search_snapshot
+        self.search_snapshot_max_age = search_snapshot_max_age
+        self.delivery_latency = Latency()
+        self._delivery = KeyedPool('delivery', delivery_workers)
+        self._dispatcher = KeyedPool('dispatcher', dispatch_workers)
+        configure_user_cache(user_cache_size, user_cache_ttl)
+        vcard.configure(user_cache_size, user_cache_ttl)
+        self._buddies = LRUCache(size=user_cache_size, ttl=user_cache_ttl)
+        self._presence = None
+        self._vcard = None
+        # Each dispatcher thread waits for its own tweet,
+        # so batch could not be larger than their number.
+        self._tweets = TweetWriter(
+            min(tweet_flush_rows, max(dispatch_workers, 1)),
+            tweet_flush_delay
+        )
+        self._online = PresenceTracker(spool_limit)
+        self.spool_digest = spool_digest
+        self.max_digest_window = max_digest_window
+        self._digests = DigestBuffer(self._send_digest)
+        self._limiter = RateLimiter(
+            user_rate = rate_limit_user,
+            user_burst = rate_limit_user_burst,
+            global_rate = rate_limit_global,
+            global_burst = rate_limit_global_burst,
+        )
+        self._bootstrap = PresenceBootstrap(
+            self,
+            rate = presence_rate,
+            page_size = presence_page_size,
+        )
+
+        self.command_latency = dict(
+            (_command_name(func), Latency())
+            for regex, func, help in self._COMMANDS
+        )
+        self.command_latency['post'] = Latency()
 
     def _load_state(self):
         state_filename = os.path.expanduser('~/.cleartext-bot.yml')
@@ -381,12 +559,10 @@ class Bot(Commands):
         with open(os.path.expanduser('~/.cleartext-bot.yml'), 'w') as f:
             yaml.dump(self.state, f)
 
-    def _send_changes(self, users):
-        """Sends changes to users if bot have configured,
-
-        Also, this method increments version number in the bot's state.
+    def _changes_message(self):
+        """Returns changes since the last run if bot have configured
+        to send them and it was upgraded, otherwise None.
         """
-
         if self.changelog_notifications:
             changes = changelog.load()
             new_version = V(__version__)
@@ -404,46 +580,106 @@ class Bot(Commands):
                     post.append('\nVersion %s:' % version_string)
                     for line in messages:
                         post.append('  * ' + line)
+                return '\n'.join(post)
+        return None
+
+    def _get_announced(self):
+        """Returns the last user, who got changes of this version."""
+        announced = self.state.get('announced')
+        if announced and announced['version'] == __version__:
+            return announced['username']
+        return None
+
+    def _set_announced(self, username):
+        self.state['announced'] = dict(version=__version__, username=username)
+        self._save_state()
 
-                for user in users:
-                    self.send_message(
-                        user.jid,
-                        '\n'.join(post),
-                        mfrom = self.jid,
-                        mtype = 'chat'
-                    )
+    def _changes_sent(self):
+        """Increments version number in the bot's state."""
         self.state['version'] = __version__
+        self.state.pop('announced', None)
+        self._save_state()
 
-    def _handle_get_vcard(self, event):
-        with open(self.avatar) as file:
-            vcard = self.xmpp.plugin['xep_0054'].make_vcard(
-                FN = self.firstname,
-                NICKNAME = self.nickname,
-                PHOTO = dict(
-                    TYPE = 'image/jpeg',
-                    BINVAL = base64.standard_b64encode(file.read()),
+    def _get_vcard(self):
+        """Returns bot's vCard, it is rebuilt only when avatar was changed."""
+        mtime = os.path.getmtime(self.avatar)
+        if self._vcard is None or self._vcard[0] != mtime:
+            with open(self.avatar) as file:
+                vcard = self.xmpp.plugin['xep_0054'].make_vcard(
+                    FN = self.firstname,
+                    NICKNAME = self.nickname,
+                    PHOTO = dict(
+                        TYPE = 'image/jpeg',
+                        BINVAL = base64.standard_b64encode(file.read()),
+                    )
                 )
-            )
-        self.xmpp.plugin['xep_0054'].return_vcard(event, vcard)
+            self._vcard = (mtime, vcard)
+        return self._vcard[1]
+
+    def _handle_get_vcard(self, event):
+        self.xmpp.plugin['xep_0054'].return_vcard(event, self._get_vcard())
 
     def _send_presence(self, jid):
         """ Sends presence along with some extensions.
+
+        Presence is the same for all users, so it is
+        serialized once and only recipient is changed.
         """
-        presence = self.xmpp.Presence(sfrom=self.jid, sto=jid)
+        if self._presence is None:
+            presence = self.xmpp.Presence(sfrom=self.jid, sto=_RECIPIENT)
 
-        # vCard update
-        vcard_update = ET.Element('{vcard-temp:x:update}x')
-        photo = ET.SubElement(vcard_update, 'photo')
-        photo.text = hashlib.sha1('random').hexdigest()
+            # vCard update
+            vcard_update = ET.Element('{vcard-temp:x:update}x')
+            photo = ET.SubElement(vcard_update, 'photo')
+            photo.text = hashlib.sha1('random').hexdigest()
 
-        presence.setPayload(vcard_update)
+            presence.setPayload(vcard_update)
 
-        # Chat status
-        show = ET.Element('{%s}show' % self.xmpp.default_ns)
-        show.text = 'chat'
-        presence.setPayload(show)
+            # Chat status
+            show = ET.Element('{%s}show' % self.xmpp.default_ns)
+            show.text = 'chat'
+            presence.setPayload(show)
 
-        self.xmpp.send(presence)
+            self._presence = str(presence).split(_RECIPIENT, 1)
+
+        head, tail = self._presence
+        self.xmpp.sendRaw(head + _escape_jid(jid) + tail)
+
+    def _buddy_template(self, jid, session):
+        """Returns 'x' node with the sender's buddy info.
+
+        Nodes are cached by bare jid along with the sender's
+        username, parsed vCard and avatar hash. Cached node is
+        checked without user's lookup, against the vCard cache,
+        and is rebuilt when vCard or avatar was changed.
+        Returned node is shared, callers should copy it
+        before any changes.
+        """
+        jid = jid.split('/', 1)[0]
+        cached = self._buddies.get(jid)
+        if cached is not None:
+            username, info, avatar_hash, x_e = cached
+            if vcard.get(username, session) is info and \
+                    self.users[username].get('photo', '') == avatar_hash:
+                return x_e
+
+        user = get_user_by_jid(jid, session)
+        info = user.vcard_info
+        avatar_hash = self.users[user.username].get('photo', '')
+
+        ns = '{http://cleartext.net/mblog}'
+        x_e = ET.Element(ns + 'x')
+        buddy_e = ET.SubElement(x_e, 'buddy', type='sender')
+        ET.SubElement(buddy_e, 'displayName').text = \
+            info and info.nickname \
+            or user.username
+        ET.SubElement(buddy_e, 'userName').text = user.username
+        ET.SubElement(buddy_e, 'jid').text = user.jid
+        ET.SubElement(buddy_e, 'avatar', type='hash').text = avatar_hash
+        ET.SubElement(buddy_e, 'serviceJid').text = self.jid
+
+        self._buddies.set(jid, (user.username, info, avatar_hash, x_e))
+        return x_e
 
     def _send_presence_probe(self, jid):
         self.xmpp.sendPresence(
@@ -452,20 +688,41 @@ class Bot(Commands):
             pto = jid,
         )
 
-    @db_session
-    def handle_xmpp_connected(self, event, session=None):
-        users = get_all_users(session)
+    def handle_xmpp_connected(self, event):
+        # presences will be received again in reply to probes
+        self._online.reset()
+        self._bootstrap.start()
 
-        for user in users:
-            self.log.debug('sending presence to jid "%s"' % user.jid)
-            self._send_presence(user.jid)
-            self._send_presence_probe(user.jid)
+    def check_rate(self, jid):
+        """Raises RateLimited if user sends messages too fast."""
+        self._limiter.check(jid.split('/', 1)[0])
 
-        self._send_changes(users)
-        self._save_state()
+    def _handle_message(self, event, admitted=False):
+        """Passes message to the dispatcher.
+
+        Messages from one user are processed one by one, in order
+        they were received, messages from different users are
+        processed in parallel. Returns a task, which could be waited.
+
+        Messages over the rate limit are rejected and None is returned,
+        unless 'admitted' is True, because the caller has already checked it.
+        """
+        if not admitted and event['type'] != 'error':
+            try:
+                self.check_rate(event['from'].jid)
+            except RateLimited, e:
+                self.xmpp.sendMessage(event['from'].jid, str(e), mfrom=self.jid, mtype='chat')
+                return None
+
+        # keyed by bare jid, so messages from all user's
+        # resources and from the frontend are processed in order
+        return self._dispatcher.submit(
+            event['from'].jid.split('/', 1)[0],
+            self._process_message, event
+        )
 
     @db_session
-    def _handle_message(self, event, session=None):
+    def _process_message(self, event, session=None):
         try:
             if event['type'] == 'error':
                 # Do nothing if this is error message from the server
@@ -476,7 +733,11 @@ class Bot(Commands):
             event.payload = payload
 
             if self._handle_commands(event, session) == False:
-                self.handle_new_message(event, session)
+                started = time.time()
+                try:
+                    self.handle_new_message(event, session)
+                finally:
+                    self.command_latency['post'].add(time.time() - started)
         except Exception, e:
             self.log.exception('error during XMPP event processing')
             if self.debug:
@@ -488,6 +749,57 @@ class Bot(Commands):
         # TODO think what to do on status change
         pass
 
+    def _handle_got_online(self, event):
+        jid = event['from'].jid.split('/', 1)[0]
+        messages = self._online.set_online(jid)
+        if messages:
+            self._send_spooled(jid, messages)
+        self._delivery.submit(jid, self._save_presence, jid, True)
+
+    def _handle_got_offline(self, event):
+        jid = event['from'].jid.split('/', 1)[0]
+        self._online.set_offline(jid)
+        self._delivery.submit(jid, self._save_presence, jid, False)
+
+    @db_session
+    def _save_presence(self, jid, presence, session=None):
+        set_presence(jid, presence, session)
+
+    def _send_digest(self, jid, bodies):
+        self.send_bulk(
+            [jid],
+            'Digest of %d notifications:\n\n' % len(bodies) + '\n\n'.join(bodies),
+            mfrom = self.jid,
+            mtype = 'chat',
+            coalesce = False
+        )
+
+    @db_session
+    def _load_digests(self, session=None):
+        self._digests.load(get_digest_windows(session))
+
+    def _send_spooled(self, jid, messages):
+        """Sends messages, spooled while user was offline.
+
+        If there are more than 'spool_digest' of them,
+        only bodies are sent, joined in one message.
+        """
+        if self.spool_digest and len(messages) > self.spool_digest:
+            self.xmpp.sendMessage(
+                jid,
+                'While you were offline:\n\n' + '\n\n'.join(
+                    body for head, tail, body in messages
+                ),
+                mfrom = self.jid,
+                mtype = 'chat'
+            )
+        else:
+            escaped = _escape_jid(jid)
+            self.xmpp.sendRaw(''.join(
+                head + escaped + tail
+                for head, tail, body in messages
+            ))
+
     def _handle_presence_probe(self, event):
         self._send_presence(event['from'].jid)
 
@@ -496,7 +808,12 @@ class Bot(Commands):
             if part.tag == '{vcard-temp:x:update}x':
                 el = part.find('{vcard-temp:x:update}photo')
                 if el is not None:
-                    self.users[event['from'].jid.split('@', 1)[0]]['photo'] = el.text
+                    username = event['from'].jid.split('@', 1)[0]
+                    if self.users[username].get('photo') != el.text:
+                        invalidate_user(jid=event['from'].jid)
+                        vcard.invalidate(username)
+                        self._buddies.pop(event['from'].jid.split('/', 1)[0])
+                    self.users[username]['photo'] = el.text
 
     def _handle_presence_subscribe(self, subscription):
         user_jid = subscription['from'].jid
@@ -528,29 +845,126 @@ class Bot(Commands):
             )
             return
 
+        username, jid = from_user.username, from_user.jid
         try:
-            tweet = Tweet(
-                username = from_user.username,
-                text = text,
-            )
-            session.add(tweet)
+            self._tweets.write(username, text, session)
         except Exception:
             self.log.exception('can\'t save tweet')
+            self.send_message(
+                jid,
+                'Sorry, your message has not been posted, please try again later.',
+                mfrom = self.jid,
+                mtype = 'chat'
+            )
+            return
+
+        # Followers, mentioned users and searchers are notified
+        # in the delivery pool. All posts, replies and direct
+        # messages of one user are sent by the same thread, so
+        # everybody receives them in order. Posts of different
+        # users are delivered in parallel, in no particular order.
+        self._delivery.submit(
+            username,
+            self._fan_out, event, username, time.time()
+        )
+
+    def _send_in_order(self, from_username, mto, body, payload):
+        """Sends message after all earlier posts of the user were delivered.
+
+        Message goes through the same spool as posts, so offline
+        recipient gets it after them, not before, from the server.
+        """
+        self._delivery.submit(
+            from_username,
+            self.send_bulk, [mto], body,
+            mfrom = self.jid,
+            mtype = 'chat',
+            payload = payload,
+            coalesce = False
+        )
+
+    @db_session
+    def _fan_out(self, event, from_username, committed_at, session=None):
+        text = event['body']
+        from_user = get_user_by_username(from_username, session)
+
+        subscribers = GRAPH.subscribers(from_user.username, session)
 
         body = '@%s: %s' % (from_user.username, text)
-        for subscriber in from_user.subscribers:
-            self.send_message(subscriber.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+        self.send_bulk(
+            GRAPH.jids(subscribers, session).itervalues(),
+            body,
+            mfrom = self.jid,
+            mtype = 'chat',
+            payload = event.payload
+        )
 
-        body = 'Mention by @%s: %s' % (from_user.username, text)
-        for username in re.findall(r'\W@\w+', text):
-            try:
-                user = get_user_by_username(username[1:], session)
-            except UserNotFound:
-                continue
-            if user not in from_user.subscribers:
-                self.send_message(user.jid, body, mfrom=self.jid, mtype='chat', payload=event.payload)
+        # Mentioned users, who don't follow the author,
+        # are resolved at once and get the same stanza.
+        mentioned = GRAPH.jids(set(_MENTION.findall(text)), session)
+        self.send_bulk(
+            (jid for username, jid in mentioned.iteritems()
+                if username not in subscribers),
+            'Mention by @%s: %s' % (from_user.username, text),
+            mfrom = self.jid,
+            mtype = 'chat',
+            payload = event.payload
+        )
 
         search.process_message(event)
+        self.delivery_latency.add(time.time() - committed_at)
+
+    def stats(self):
+        """Returns bot's gauges and counters for monitoring.
+
+        'commands' contains processing time of each command,
+        including 'post'.
+
+        'delivery.latency' is the time in seconds between tweet's
+        commit and the last notification to followers and mentioned
+        users. Search notifications are measured by the search module.
+
+        'tweets' contains sizes and durations of tweets' commits
+        and time, posts waited for them.
+
+        'presence' contains number of online users and
+        messages, spooled for offline ones.
+
+        'digests' contains number of users in the digest mode
+        and notifications, buffered for them.
+
+        'ratelimit' contains number of accepted messages and
+        messages, rejected by per-user and global limits.
+
+        'bootstrap' is progress of sending presences after connect.
+
+        'users', 'vcards' and 'buddies' contain hits and misses
+        of the users, parsed vCards and buddy nodes caches.
+        """
+        return dict(
+            dispatcher = dict(
+                workers = len(self._dispatcher),
+                depth = self._dispatcher.qsize(),
+            ),
+            commands = dict(
+                (name, latency.as_dict())
+                for name, latency in self.command_latency.iteritems()
+            ),
+            delivery = dict(
+                workers = len(self._delivery),
+                depth = self._delivery.qsize(),
+                latency = self.delivery_latency.as_dict(),
+            ),
+            search = search.stats(),
+            tweets = self._tweets.stats(),
+            presence = self._online.stats(),
+            digests = self._digests.stats(),
+            ratelimit = self._limiter.stats(),
+            bootstrap = self._bootstrap.stats(),
+            users = user_cache_stats(),
+            vcards = vcard.stats(),
+            buddies = self._buddies.as_dict(),
+        )
 
     def send_message(self, mto, mbody,
             msubject=None, mtype=None, mhtml=None,
@@ -561,14 +975,60 @@ class Bot(Commands):
             msg.setPayload(item)
         self.xmpp.send(msg)
 
+    def send_bulk(self, mtos, mbody,
+            msubject=None, mtype=None, mhtml=None,
+            mfrom=None, mnick=None, payload=[], batch_size=100,
+            coalesce=True):
+        """Sends the same message to many recipients.
+
+        Message is built and serialized only once. Copies, which
+        differ only in the 'to' attribute, are sent in batches,
+        with one write for every 'batch_size' recipients.
+        Copies for offline users are spooled until they are online.
+        If 'coalesce' is True, users in the digest mode receive
+        only body, later, in the digest.
+        """
+        mtos = list(mtos)
+        if coalesce:
+            mtos = self._digests.deliver(mtos, mbody)
+        if not mtos:
+            return
+
+        msg = self.xmpp.makeMessage(_RECIPIENT,mbody,msubject,mtype,mhtml,mfrom,mnick)
+        for item in payload:
+            msg.setPayload(item)
+
+        head, tail = str(msg).split(_RECIPIENT, 1)
+        mtos = self._online.deliver(mtos, (head, tail, mbody))
+
+        for idx in xrange(0, len(mtos), batch_size):
+            self.xmpp.sendRaw(''.join(
+                head + _escape_jid(mto) + tail
+                for mto in mtos[idx:idx + batch_size]
+            ))
+
     def start(self):
-        search.start(self)
+        search.start(
+            self,
+            queue_size = self.search_queue_size,
+            queue_policy = self.search_queue_policy,
+        )
+        self._get_vcard()
+        self._load_digests()
         self.xmpp.connect()
         self.xmpp.process(threaded=False)
 
     def stop(self):
+        self._bootstrap.stop()
+        self._dispatcher.stop()
+        self._tweets.stop()
+        self._delivery.stop()
         search.stop()
+        self._digests.stop()
         if self.xmpp.socket is not None:
+            # server will keep them as offline messages
+            for jid, messages in self._online.drain().iteritems():
+                self._send_spooled(jid, messages)
             self.xmpp.disconnect()
 
 
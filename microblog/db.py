@@ -25,19 +25,31 @@ class DebugListener(PoolListener):
 
 
 
-def init(cfg):
+def init(cfg, min_sessions=0):
     """This function should be called before Session use.
 
     Input is a dict like object with databases settings from the config.
+    If 'pool_size' is not set, pool is sized for 'min_sessions'
+    sessions, if it is set too small, ValueError is raised, because
+    threads would wait for connections forever.
     """
     database_uri = 'mysql://%(username)s:%(password)s@%(host)s/%(dbname)s' % cfg
 
     opts = dict(
         pool_recycle = cfg.get('pool_recycle', 3600),
-        pool_size = cfg.get('pool_size', 5),
+        pool_size = cfg.get('pool_size', max(5, min_sessions)),
         max_overflow = cfg.get('max_overflow', 0),
     )
 
+    if opts['max_overflow'] >= 0 and \
+            opts['pool_size'] + opts['max_overflow'] < min_sessions:
+        raise ValueError(
+            'Database pool_size + max_overflow is %d, but %d sessions '
+            'could be used at once, increase pool_size.' % (
+                opts['pool_size'] + opts['max_overflow'], min_sessions
+            )
+        )
+
     if cfg.get('debug', False):
         opts['echo'] = True
         opts['listeners'] = [DebugListener()]
@@ -62,6 +74,7 @@ def db_session(func):
                 raise
             finally:
                 session.close()
+        return func(*args, **kwargs)
 
     return wrapper
 
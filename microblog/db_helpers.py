@@ -2,24 +2,137 @@
 Different database helpers, to retrive
 information about users.
 """
-from microblog.models import User
+import cPickle as pickle
+
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.attributes import instance_dict, instance_state
+from sqlalchemy.orm.properties import RelationshipProperty
+
+from microblog.models import User, subscribers_t
 from microblog.exceptions import UserNotFound
+from microblog.utils import LRUCache
+
+# Identity cache, keyed by ('jid', bare_jid) and ('username', username).
+# It keeps detached copies of users with column attributes only,
+# each lookup merges a copy into the caller's session, so
+# the same cached user is never shared between sessions or threads.
+# User, which is already in the session, is returned as is,
+# so its changes are not overwritten by the cached copy.
+_users = LRUCache(size=10000, ttl=300)
+
+
+def configure_user_cache(size, ttl):
+    """Changes size and time to live of the users cache."""
+    _users.size = size
+    _users.ttl = ttl
+    _users.clear()
+
+
+def invalidate_user(username=None, jid=None):
+    """Removes user from the cache.
+
+    Should be called when user's data, including vCard, was changed.
+    """
+    for key in (('username', username), ('jid', jid and jid.split('/', 1)[0])):
+        if key[1] is not None:
+            detached = _users.pop(key)
+            if detached is not None:
+                _users.pop(('username', detached.username))
+                _users.pop(('jid', detached.jid))
+
+
+def user_cache_stats():
+    return _users.as_dict()
+
+
+def _detach(user):
+    """Returns user's copy without session and relations."""
+    detached = pickle.loads(pickle.dumps(user, pickle.HIGHEST_PROTOCOL))
+    state = instance_dict(detached)
+    for prop in class_mapper(User).iterate_properties:
+        if isinstance(prop, RelationshipProperty):
+            state.pop(prop.key, None)
+    return detached
+
+
+def _get_user(key, criterion, session):
+    detached = _users.get(key)
+    if detached is not None:
+        user = session.identity_map.get(instance_state(detached).key)
+        if user is not None:
+            return user
+        return session.merge(detached, load=False)
+
+    user = session.query(User).filter(criterion).scalar()
+    if user is not None:
+        detached = _detach(user)
+        _users.set(('username', user.username), detached)
+        _users.set(('jid', user.jid), detached)
+    return user
+
 
 def get_user_by_jid(jid, session):
     jid = jid.split('/', 1)[0]
-    user = session.query(User).filter(User.jid==jid).scalar()
+    user = _get_user(('jid', jid), User.jid==jid, session)
     if user is None:
         raise UserNotFound('User with jid "%s" not found.' % jid)
     return user
 
 
+def set_presence(jid, presence, session):
+    """Saves user's presence, without loading the user."""
+    session.query(User).filter(
+        User.jid == jid.split('/', 1)[0]
+    ).update({'presence': presence}, synchronize_session=False)
+
+
+def get_digest_windows(session):
+    """Returns a dict jid -> digest window in seconds for users in the digest mode."""
+    return dict(
+        (jid, minutes * 60)
+        for jid, minutes in session.query(User.jid, User.digest).filter(User.digest > 0)
+    )
+
+
 def get_all_users(session):
     return session.query(User)
 
 
 def get_user_by_username(username, session):
-    user = session.query(User).filter(User.username==username).scalar()
+    user = _get_user(('username', username), User.username==username, session)
     if user is None:
         raise UserNotFound('User with username "%s" not found.' % username)
     return user
 
+
+
+def get_jids_by_usernames(usernames, session, chunk_size=1000):
+    """Returns a dict username -> jid for all found users.
+
+    Users are fetched with one query per 'chunk_size' usernames.
+    """
+    usernames = list(usernames)
+    result = {}
+    for idx in xrange(0, len(usernames), chunk_size):
+        result.update(
+            session.query(User.username, User.jid).filter(
+                User.username.in_(usernames[idx:idx + chunk_size])
+            )
+        )
+    return result
+
+
+def add_subscriber(username, subscriber, session):
+    """Makes 'subscriber' a follower of 'username'."""
+    session.execute(subscribers_t.insert().values(
+        user = username,
+        subscriber = subscriber,
+    ))
+
+
+def remove_subscriber(username, subscriber, session):
+    """Stops 'subscriber' to follow 'username'."""
+    session.execute(subscribers_t.delete().where(
+        (subscribers_t.c.user == username) &
+        (subscribers_t.c.subscriber == subscriber)
+    ))
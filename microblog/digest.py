@@ -0,0 +1,127 @@
+"""
+Digests for users, who don't want a message for every post.
+"""
+import logging
+import threading
+import time
+
+
+class DigestBuffer(object):
+    """Coalesces notifications for users in the digest mode.
+
+    Each user has own window in seconds. The first buffered
+    notification starts the window, when it ends, all bodies
+    are passed to 'send(jid, bodies)' at once. No more than
+    'max_messages' bodies are buffered, a full buffer is
+    sent right away.
+    """
+
+    def __init__(self, send, max_messages=100):
+        self.max_messages = max_messages
+        self.log = logging.getLogger('digest')
+        self._send = send
+        self._windows = {}
+        self._buffers = {}
+        self._stopped = False
+        self._cond = threading.Condition()
+
+        self._thread = threading.Thread(target=self._worker, name='digest')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def load(self, windows):
+        """Replaces all windows with a dict jid -> seconds."""
+        with self._cond:
+            self._windows = dict(windows)
+
+    def get_window(self, jid):
+        return self._windows.get(jid.split('/', 1)[0], 0)
+
+    def set_window(self, jid, seconds):
+        """Changes user's window, zero turns the digest mode off."""
+        jid = jid.split('/', 1)[0]
+        with self._cond:
+            if seconds:
+                self._windows[jid] = seconds
+            else:
+                self._windows.pop(jid, None)
+                if jid in self._buffers:
+                    # send buffered messages now
+                    self._buffers[jid][0] = 0
+                    self._cond.notify()
+
+    def deliver(self, jids, body):
+        """Buffers body for users in the digest mode, returns other jids."""
+        if not self._windows:
+            return jids
+
+        result = []
+        now = time.time()
+        with self._cond:
+            for jid in jids:
+                bare = jid.split('/', 1)[0]
+                window = self._windows.get(bare)
+                if not window:
+                    result.append(jid)
+                    continue
+
+                buffer = self._buffers.get(bare)
+                if buffer is None:
+                    buffer = self._buffers[bare] = [now + window, []]
+                    self._cond.notify()
+
+                buffer[1].append(body)
+                if len(buffer[1]) >= self.max_messages:
+                    buffer[0] = 0
+                    self._cond.notify()
+        return result
+
+    def stop(self):
+        """Sends all buffered messages and stops the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                users = len(self._windows),
+                buffered_users = len(self._buffers),
+                buffered_messages = sum(
+                    len(bodies) for due_at, bodies in self._buffers.itervalues()
+                ),
+            )
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    if self._stopped:
+                        due, self._buffers = self._buffers, {}
+                        break
+
+                    due = dict(
+                        (jid, buffer) for jid, buffer in self._buffers.iteritems()
+                        if buffer[0] <= now
+                    )
+                    if due:
+                        for jid in due:
+                            del self._buffers[jid]
+                        break
+
+                    if self._buffers:
+                        timeout = min(buffer[0] for buffer in self._buffers.itervalues()) - now
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+
+            for jid, (due_at, bodies) in due.iteritems():
+                try:
+                    self._send(jid, bodies)
+                except Exception:
+                    self.log.exception('Can\'t send digest to %s' % jid)
+
+            if self._stopped:
+                return
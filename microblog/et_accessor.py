@@ -6,11 +6,24 @@
 #########################################################
 
 
+_SLOTS = frozenset(('xml', '_ns', '_children'))
+_MISSING = object()
+
+
 class Accessor(object):
-    """Easy to use ElementTree accessor."""
+    """Easy to use ElementTree accessor.
+
+    Children are looked up once for each tag, then found
+    wrappers are reused, so the element should not be
+    changed after it was wrapped.
+    """
 
-    def __init__(self, xml):
+    __slots__ = ('xml', '_ns', '_children')
+
+    def __init__(self, xml, ns=None):
         self.xml = xml
+        self._ns = ns
+        self._children = {}
 
     def __repr__(self):
         return '<Element %s>' % self.xml.tag
@@ -21,7 +34,34 @@ class Accessor(object):
     def __iter__(self):
         return iter(self.xml)
 
-    def __getattribute__(self, name):
+    def __len__(self):
+        return len(self.xml)
+
+    def __nonzero__(self):
+        # wrapper is true even without children, as it was before __len__
+        return True
+
+    def _find(self, name):
+        """Returns wrapper, list of wrappers or None for children with this tag."""
+        ns = self._ns
+        if ns is None:
+            tag = self.xml.tag
+            ns = self._ns = tag[0] == '{' and tag[:tag.rfind('}') + 1] or ''
+
+        # children have the same namespace, because they were found by it
+        elements = self.xml.findall(ns + name)
+        l = len(elements)
+        if l == 1:
+            child = Accessor(elements[0], ns)
+        elif l > 1:
+            child = [Accessor(element, ns) for element in elements]
+        else:
+            child = None
+
+        self._children[name] = child
+        return child
+
+    def __getattr__(self, name):
         """
 >>> from xml.etree import ElementTree as ET
 >>> xml = ET.fromstring('<a b="blah"><c id="1"/><c id="2"><d>Hello</d></c></a>')
@@ -37,25 +77,20 @@ class Accessor(object):
 >>> ET.tostring(a)
 '<a b="blah"><c id="1" /><c id="2"><d>Hello</d></c></a>'
 """
-        if name == 'xml':
-            return object.__getattribute__(self, name)
+        if name in _SLOTS:
+            raise AttributeError(name)
 
-        self_tag = self.xml.tag
-        if self_tag[0] == '{':
-            el_name = self_tag[:self_tag.rfind('}') + 1] + name
-        else:
-            el_name = name
+        child = self._children.get(name, _MISSING)
+        if child is _MISSING:
+            child = self._find(name)
 
-        elements = self.xml.findall(el_name)
-        l = len(elements)
-        if l == 1:
-            return Accessor(elements[0])
-        elif l > 1:
-            return map(Accessor, elements)
+        if child is not None:
+            if type(child) is list:
+                return list(child)
+            return child
 
-        if self.xml.attrib.has_key(name):
-            return self.xml.attrib[name]
+        attrib = self.xml.attrib
+        if name in attrib:
+            return attrib[name]
 
-        if hasattr(self.xml, name):
-            return getattr(self.xml, name)
-        return ''
+        return getattr(self.xml, name, '')
@@ -1 +1,2 @@
 class UserNotFound(RuntimeError): pass
+class RateLimited(RuntimeError): pass
@@ -1,5 +1,4 @@
 import logging
-import base64
 from urllib import quote
 import os.path
 import tornado.httpserver
@@ -12,8 +11,11 @@ from collections import defaultdict
 from microblog.db import Session
 from microblog.db_helpers import \
     get_user_by_username, \
-    get_all_users
-from microblog.exceptions import UserNotFound
+    get_all_users, \
+    add_subscriber, \
+    remove_subscriber
+from microblog.exceptions import UserNotFound, RateLimited
+from microblog.graph import GRAPH
 from microblog.models import User
 from microblog.queue import QUEUE
 from pdb import set_trace
@@ -76,7 +78,7 @@ class User(Handler):
         self.render(
             'user.html',
             user = user,
-            vcard = user.vcard,
+            vcard = user.vcard_info,
             mypage = user == self.current_user,
         )
 
@@ -93,7 +95,9 @@ class Follow(Handler):
     def post(self, username):
         if self.get_argument('choice') == 'YES':
             user = get_user_by_username(username, self._session)
-            user.subscribers.append(self.current_user)
+            add_subscriber(user.username, self.current_user.username, self._session)
+            self._session.commit()
+            GRAPH.follow(self.current_user.username, user.username)
         next = self.get_argument('next', '/')
         self.redirect(next)
 
@@ -109,7 +113,9 @@ class Unfollow(Handler):
     def post(self, username):
         if self.get_argument('choice') == 'YES':
             user = get_user_by_username(username, self._session)
-            user.subscribers.remove(self.current_user)
+            remove_subscriber(user.username, self.current_user.username, self._session)
+            self._session.commit()
+            GRAPH.unfollow(self.current_user.username, user.username)
         next = self.get_argument('next', '/')
         self.redirect(next)
 
@@ -117,14 +123,12 @@ class Unfollow(Handler):
 class Avatar(Handler):
     def get(self, username):
         user = get_user_by_username(username, self._session)
-        vc = user.vcard
-        if vc is None or vc.PHOTO is None:
+        vc = user.vcard_info
+        if vc is None or vc.photo is None:
             raise tornado.web.HTTPError(404)
-        else:
-            message = base64.standard_b64decode(vc.PHOTO.BINVAL.text)
-            self.set_header('Content-Type', vc.PHOTO.TYPE or 'image/jpeg')
 
-        self.write(message)
+        self.set_header('Content-Type', vc.photo_type)
+        self.write(vc.photo)
 
 
 class Login(Handler):
@@ -171,7 +175,13 @@ class Post(Handler):
         text = escape.xhtml_escape(text)
         user = self.get_current_user()
 
-        QUEUE.add('post', text=text, user=user)
+        try:
+            QUEUE.add('post', text=text, user=user)
+        except RateLimited, e:
+            self.set_status(503)
+            self.set_header('Retry-After', '10')
+            self.write(str(e))
+            return
 
         next = self.get_argument('next', '/')
         self.redirect(next)
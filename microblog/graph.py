@@ -0,0 +1,111 @@
+"""
+In-memory graph of followers.
+"""
+import logging
+import threading
+
+from microblog.db_helpers import get_jids_by_usernames
+from microblog.models import User, subscribers_t
+
+_EMPTY = frozenset()
+
+
+class FollowerGraph(object):
+    """Process-wide cache of who follows whom, along with users' jids.
+
+    Graph is loaded from the database on first use and then
+    is updated in place by the follow/unfollow handlers.
+    Adjacency sets are frozensets, replaced on every change,
+    so readers never lock and never see a half-updated set.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = None # username to followers' usernames
+        self._contacts = None # username to usernames they follow
+        self._jids = {}
+
+    def _ensure_loaded(self, session):
+        if self._subscribers is not None:
+            return
+
+        with self._lock:
+            if self._subscribers is not None:
+                return
+
+            subscribers = {}
+            contacts = {}
+            for user, subscriber in session.query(
+                    subscribers_t.c.user, subscribers_t.c.subscriber):
+                subscribers.setdefault(user, set()).add(subscriber)
+                contacts.setdefault(subscriber, set()).add(user)
+
+            self._jids.update(session.query(User.username, User.jid))
+            self._contacts = dict(
+                (key, frozenset(value)) for key, value in contacts.iteritems()
+            )
+            self._subscribers = dict(
+                (key, frozenset(value)) for key, value in subscribers.iteritems()
+            )
+
+        logging.getLogger('graph').debug(
+            'Follower graph was loaded: %d users, %d edges.' % (
+                len(self._jids),
+                sum(len(value) for value in self._subscribers.itervalues()),
+            )
+        )
+
+    def subscribers(self, username, session):
+        """Returns a frozenset with usernames of user's followers."""
+        self._ensure_loaded(session)
+        return self._subscribers.get(username, _EMPTY)
+
+    def contacts(self, username, session):
+        """Returns a frozenset with usernames of users, this one follows."""
+        self._ensure_loaded(session)
+        return self._contacts.get(username, _EMPTY)
+
+    def jids(self, usernames, session):
+        """Returns a dict username -> jid for all found users.
+
+        Only unknown users are fetched from the database.
+        """
+        self._ensure_loaded(session)
+
+        result = {}
+        missing = []
+        for username in usernames:
+            jid = self._jids.get(username)
+            if jid is None:
+                missing.append(username)
+            else:
+                result[username] = jid
+
+        if missing:
+            found = get_jids_by_usernames(missing, session)
+            self._jids.update(found)
+            result.update(found)
+        return result
+
+    def follow(self, username, contact):
+        """Should be called after 'username' started to follow 'contact'."""
+        self._change(username, contact, frozenset.union)
+
+    def unfollow(self, username, contact):
+        """Should be called after 'username' stopped to follow 'contact'."""
+        self._change(username, contact, frozenset.difference)
+
+    def _change(self, username, contact, op):
+        with self._lock:
+            if self._subscribers is None:
+                # will be loaded with this change
+                return
+            self._contacts[username] = op(
+                self._contacts.get(username, _EMPTY), (contact,)
+            )
+            self._subscribers[contact] = op(
+                self._subscribers.get(contact, _EMPTY), (username,)
+            )
+
+
+GRAPH = FollowerGraph()
@@ -4,7 +4,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Unicode, UnicodeText, \
                        DateTime, Table, ForeignKey, Boolean, \
                        Integer
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, object_session
 from pdb import set_trace
 
 Base = declarative_base()
@@ -31,6 +31,7 @@ class User(Base):
     created_at = Column(DateTime)
     jid = Column(Unicode, unique=True)
     presence = Column(Boolean)
+    digest = Column(Integer) # digest window in minutes, 0 - off
 
     subscribers = relationship(
         'User',
@@ -64,6 +65,15 @@ class User(Base):
             return Accessor(ET.fromstring(self._vcard.vcard))
         return None
 
+    @property
+    def vcard_info(self):
+        """Parsed and cached vCard, see microblog.vcard.VCardInfo.
+
+        Raw vCard is not loaded, unless it was changed.
+        """
+        from microblog import vcard
+        return vcard.get(self.username, object_session(self))
+
 
 class SearchTerm(Base):
     __tablename__ = 'search_terms'
@@ -0,0 +1,76 @@
+"""
+Users' presence and messages, spooled for offline users.
+"""
+import threading
+
+
+class PresenceTracker(object):
+    """Keeps bare jids of online users and spools messages for others.
+
+    Spooled message is a serialized stanza, split around the
+    recipient's jid, it is shared by all recipients, so each
+    spooled delivery costs only a reference. No more than 'limit'
+    last messages are kept for every user. Tracker with zero
+    'limit' does not spool anything.
+    """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.dropped = 0
+        self._online = set()
+        self._spool = {}
+        self._lock = threading.Lock()
+
+    def set_online(self, jid):
+        """Marks user as online, returns messages, spooled for this user."""
+        jid = jid.split('/', 1)[0]
+        with self._lock:
+            self._online.add(jid)
+            return self._spool.pop(jid, [])
+
+    def set_offline(self, jid):
+        with self._lock:
+            self._online.discard(jid.split('/', 1)[0])
+
+    def reset(self):
+        """Forgets who is online, spooled messages are kept."""
+        with self._lock:
+            self._online.clear()
+
+    def deliver(self, jids, message):
+        """Spools message for offline users, returns jids of online ones.
+
+        'message' is a tuple (head, tail, body).
+        """
+        if not self.limit:
+            return jids
+
+        online = []
+        with self._lock:
+            for jid in jids:
+                bare = jid.split('/', 1)[0]
+                if bare in self._online:
+                    online.append(jid)
+                    continue
+
+                spool = self._spool.setdefault(bare, [])
+                spool.append(message)
+                if len(spool) > self.limit:
+                    del spool[0]
+                    self.dropped += 1
+        return online
+
+    def drain(self):
+        """Removes and returns all spooled messages as a dict jid -> messages."""
+        with self._lock:
+            spool, self._spool = self._spool, {}
+        return spool
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                online = len(self._online),
+                spooled_users = len(self._spool),
+                spooled_messages = sum(len(s) for s in self._spool.itervalues()),
+                dropped = self.dropped,
+            )
@@ -1,4 +1,3 @@
-import hashlib
 from sleekxmpp.stanza.message import Message, ET
 
 
@@ -17,17 +16,21 @@ class TaskQueue(object):
         self.bot = bot
 
     def add(self, name, *args, **kwargs):
-        """ Accepts new task in form (name, args, kwargs) """
+        """ Accepts new task in form (name, args, kwargs)
+
+        Raises RateLimited if task's user sends too many tasks.
+        """
         func = getattr(self, 'do_' + name, None)
         if func is not None:
+            user = kwargs.get('user')
+            if self.bot and user is not None:
+                self.bot.check_rate(user.jid)
             func(*args, **kwargs)
 
     def do_post(self, text=None, user=None):
         if self.bot:
-            if user.vcard and user.vcard.PHOTO:
-                avatar_hash = hashlib.sha1(user.vcard.PHOTO.BINVAL.text).hexdigest()
-            else:
-                avatar_hash = ''
+            vcard = user.vcard_info
+            avatar_hash = vcard and vcard.avatar_hash or ''
 
             event = Message(
                 stream = self.bot.xmpp, xml=ET.fromstring("""
@@ -40,7 +43,10 @@ class TaskQueue(object):
     text = text,
     avatar_hash = avatar_hash,
 )))
-            self.bot._handle_message(event)
+            # Post is processed in the bot's thread,
+            # but frontend waits until it's done.
+            # Rate is already checked in 'add'.
+            self.bot._handle_message(event, admitted=True).wait()
 
 
 QUEUE = TaskQueue()
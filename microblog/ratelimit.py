@@ -0,0 +1,91 @@
+"""
+Admission control for users' messages.
+"""
+import threading
+import time
+
+from microblog.exceptions import RateLimited
+from microblog.utils import LRUCache
+
+
+class TokenBucket(object):
+    """Allows 'rate' actions per second with bursts up to 'burst' actions."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now or time.time()
+
+    def consume(self, now, amount=1):
+        """Takes tokens if there are enough of them, returns True if it did."""
+        self.tokens = min(
+            self.burst,
+            self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class RateLimiter(object):
+    """Per-user and global token buckets.
+
+    Zero rate turns the corresponding limit off. Buckets of
+    no more than 'max_users' recently active users are kept,
+    a forgotten user starts again with a full bucket.
+    """
+
+    def __init__(self, user_rate=0, user_burst=10,
+                 global_rate=0, global_burst=100, max_users=100000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.allowed = 0
+        self.rejected_user = 0
+        self.rejected_global = 0
+
+        self._users = LRUCache(size=max_users)
+        self._global = global_rate and TokenBucket(global_rate, global_burst) or None
+        self._lock = threading.Lock()
+
+    def check(self, key):
+        """Takes a token for the 'key', raises RateLimited if there is none."""
+        now = time.time()
+        with self._lock:
+            bucket = None
+            if self.user_rate:
+                bucket = self._users.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.user_rate, self.user_burst, now)
+                    self._users.set(key, bucket)
+
+                if not bucket.consume(now):
+                    self.rejected_user += 1
+                    raise RateLimited(
+                        'You are sending messages too fast. '
+                        'Please wait a few seconds and try again.'
+                    )
+
+            if self._global is not None and not self._global.consume(now):
+                if bucket is not None:
+                    # this message was not accepted, give token back
+                    bucket.tokens += 1
+                self.rejected_global += 1
+                raise RateLimited(
+                    'Service is busy right now. '
+                    'Please try again in a minute.'
+                )
+
+            self.allowed += 1
+
+    def stats(self):
+        return dict(
+            allowed = self.allowed,
+            rejected_user = self.rejected_user,
+            rejected_global = self.rejected_global,
+            users = len(self._users),
+        )
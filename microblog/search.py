@@ -1,15 +1,23 @@
-import copy
+import os
+import signal
 import threading
+import time
 import logging
 import itertools
+import multiprocessing
+import zlib
 
-from Queue import Queue
-from collections import defaultdict
+from Queue import Queue, Empty
+from array import array
+from bisect import bisect_left
+from collections import deque
 from microblog.db import db_session
-from microblog.db_helpers import \
-    get_user_by_jid, \
-    get_user_by_username
+from microblog.db_helpers import get_user_by_jid
+from microblog import snapshot
+from microblog.graph import GRAPH
 from microblog.models import SearchTerm
+from microblog.snapshot import Journal
+from microblog.stats import Latency
 from sqlalchemy.orm.exc import NoResultFound
 
 
@@ -17,32 +25,757 @@ class Sentinel(object): pass
 
 
 class SearchCache(object):
-    """This class holds all search terms and usernames which are waiting results."""
+    """This class holds all search terms and usernames which are waiting results.
 
-    def __init__(self):
-        self._terms = {}
+    Besides the phrases themselves, cache keeps an inverted index
+    from each word to the phrases containing it, and an automaton
+    built from all these words, to find them in a message at once.
+
+    To keep memory footprint small, words and usernames are
+    interned and replaced with integer ids, so each phrase holds
+    only two arrays: ids of its words and sorted ids of its users.
+
+    Cache could be read and changed from different threads.
+    Readers never lock: they work with an immutable version of
+    the terms and index. Writers make changed copies of them
+    and publish a new version, so a batch of changes should be
+    applied with one 'apply' call.
+
+    New words don't stop matching for the automaton's rebuild:
+    they are searched with plain substring checks, until the
+    automaton is rebuilt in background, 'rebuild_delay' seconds
+    after the first of them was added.
+    """
+
+    def __init__(self, rebuild_delay=1.0):
+        self.rebuild_delay = rebuild_delay
+        self._version = _Version({}, {})
+        self._words = _Interned()
+        self._usernames = _Interned()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def freeze(self):
+        """Returns read only cache, which will not see further changes."""
+        frozen = SearchCache.__new__(SearchCache)
+        frozen._version = self._version
+        frozen._words = self._words
+        frozen._usernames = self._usernames
+        frozen._lock = None
+        frozen._timer = None
+        return frozen
+
+    def _word_ids(self, phrase):
+        word_ids = array('i')
+        for word in phrase.split():
+            word = word.strip()
+            if word:
+                word_ids.append(self._words.id(word))
+        return word_ids
+
+    def _view(self, entry):
+        word_ids, user_ids = entry
+        return (
+            tuple(self._words[word_id] for word_id in word_ids),
+            _Users(user_ids, self._usernames),
+        )
 
     def __getitem__(self, phrase):
-        """ Each phrase splitted and saved along with usernames.
+        """ Each phrase splitted and returned along with usernames.
+
+        Returns tuple (words, usernames), where usernames is
+        a read only set-like object.
+        """
+        entry = self._version.terms.get(phrase)
+        if entry is None:
+            return (tuple(word.strip() for word in phrase.split()), ())
+        return self._view(entry)
+
+    def __contains__(self, phrase):
+        return phrase in self._version.terms
+
+    def __len__(self):
+        return len(self._version.terms)
+
+    def items(self):
+        return (self._view(entry) for entry in self._version.terms.itervalues())
+
+    def iteritems(self):
+        """Returns pairs (phrase, (words, usernames))."""
+        return (
+            (phrase, self._view(entry))
+            for phrase, entry in self._version.terms.iteritems()
+        )
+
+    def count_rows(self):
+        """Returns number of (phrase, username) pairs."""
+        return sum(
+            len(user_ids)
+            for word_ids, user_ids in self._version.terms.itervalues()
+        )
+
+    def dump(self, path, **meta):
+        """Saves cache into a snapshot file, see microblog.snapshot."""
+        phrases = []
+        word_ids = array('i')
+        word_counts = array('i')
+        user_ids = array('i')
+        user_counts = array('i')
+
+        for phrase, (phrase_word_ids, phrase_user_ids) in self._version.terms.iteritems():
+            phrases.append(phrase)
+            word_ids.extend(phrase_word_ids)
+            word_counts.append(len(phrase_word_ids))
+            user_ids.extend(phrase_user_ids)
+            user_counts.append(len(phrase_user_ids))
+
+        snapshot.write(path, [
+                ('words', _join(self._words.values)),
+                ('usernames', _join(self._usernames.values)),
+                ('phrases', _join(phrases)),
+                ('word_ids', word_ids.tostring()),
+                ('word_counts', word_counts.tostring()),
+                ('user_ids', user_ids.tostring()),
+                ('user_counts', user_counts.tostring()),
+            ],
+            **meta
+        )
+
+    @classmethod
+    def load(cls, path):
+        """Creates cache from the snapshot file.
+
+        Returns tuple (cache, snapshot's meta).
+        """
+        snap = snapshot.Snapshot(path)
+        try:
+            cache = cls()
+            cache._words = _Interned(_split(snap['words']))
+            cache._usernames = _Interned(_split(snap['usernames']))
+            phrases = _split(snap['phrases'])
+            word_ids = _unpack(snap['word_ids'])
+            word_counts = _unpack(snap['word_counts'])
+            user_ids = _unpack(snap['user_ids'])
+            user_counts = _unpack(snap['user_counts'])
+            meta = snap.meta
+        finally:
+            snap.close()
+
+        terms = {}
+        index = {}
+        w = u = 0
+        for phrase, num_words, num_users in itertools.izip(
+                phrases, word_counts, user_counts):
+            entry = (word_ids[w:w + num_words], user_ids[u:u + num_users])
+            w += num_words
+            u += num_users
+
+            terms[phrase] = entry
+            for word_id in entry[0]:
+                phrases = index.setdefault(word_id, [])
+                if not phrases or phrases[-1] != phrase:
+                    phrases.append(phrase)
+
+        cache._version = _Version(terms, dict(
+            (word_id, tuple(phrases))
+            for word_id, phrases in index.iteritems()
+        ))
+        return cache, meta
+
+    def add(self, phrase, username):
+        self.apply((('+', phrase, username),))
+
+    def discard(self, phrase, username):
+        """Removes username from phrase's watchers.
+
+        Phrase is dropped from the cache and the index,
+        when nobody is watching for it anymore.
+        """
+        self.apply((('-', phrase, username),))
+
+    def apply(self, changes):
+        """Applies changes and publishes a new version of the cache.
+
+        Changes are tuples (op, phrase, username), where
+        op is '+' to add a search, or '-' to remove it.
         """
-        if phrase not in self._terms:
-            self._terms[phrase] = (
+        if self._lock is None:
+            raise TypeError('Frozen cache can not be changed.')
+
+        with self._lock:
+            old = self._version
+            terms = dict(old.terms)
+            index = dict(old.index)
+            new_words = []
+            copied = set() # phrases, which user ids were copied already
+
+            for op, phrase, username in changes:
+                entry = terms.get(phrase)
+
+                if op == '+':
+                    if entry is None:
+                        entry = terms[phrase] = (self._word_ids(phrase), array('i'))
+                        copied.add(phrase)
+                        for word_id in entry[0]:
+                            phrases = index.get(word_id)
+                            if phrases is None:
+                                new_words.append(word_id)
+                                index[word_id] = (phrase,)
+                            elif phrase not in phrases:
+                                index[word_id] = phrases + (phrase,)
+
+                    user_id = self._usernames.id(username)
+                    user_ids = entry[1]
+                    idx = bisect_left(user_ids, user_id)
+                    if idx == len(user_ids) or user_ids[idx] != user_id:
+                        if phrase not in copied:
+                            user_ids = array('i', user_ids)
+                            entry = terms[phrase] = (entry[0], user_ids)
+                            copied.add(phrase)
+                        user_ids.insert(idx, user_id)
+                else:
+                    user_id = self._usernames.get(username)
+                    if entry is None or user_id is None:
+                        continue
+
+                    word_ids, user_ids = entry
+                    idx = bisect_left(user_ids, user_id)
+                    if idx < len(user_ids) and user_ids[idx] == user_id:
+                        if phrase not in copied:
+                            user_ids = array('i', user_ids)
+                            terms[phrase] = (word_ids, user_ids)
+                            copied.add(phrase)
+                        del user_ids[idx]
+
+                    if not user_ids:
+                        del terms[phrase]
+                        copied.discard(phrase)
+                        for word_id in word_ids:
+                            phrases = index.get(word_id)
+                            if phrases is not None:
+                                phrases = tuple(p for p in phrases if p != phrase)
+                                if phrases:
+                                    index[word_id] = phrases
+                                else:
+                                    del index[word_id]
+
+            # Removed words don't invalidate the automaton,
+            # because it's results are checked against the index.
+            # New words are checked separately until the rebuild.
+            extra = old.extra
+            if old.automaton is not None and new_words:
+                extra += tuple(
+                    (self._words[word_id], word_id) for word_id in new_words
+                )
+                self._schedule_rebuild()
+
+            self._version = _Version(terms, index, old.automaton, extra)
+
+    def _schedule_rebuild(self):
+        """Should be called with the _lock held."""
+        if self._timer is None:
+            self._timer = threading.Timer(self.rebuild_delay, self.rebuild)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def rebuild(self):
+        """Builds automaton from all current words and publishes it.
+
+        Words, added during the build, are still checked separately.
+        """
+        with self._lock:
+            self._timer = None
+            version = self._version
+
+        automaton = _build_automaton(version.index, self._words)
+
+        with self._lock:
+            current = self._version
+            self._version = _Version(
+                current.terms,
+                current.index,
+                automaton,
                 tuple(
-                    filter(
-                        None,
-                        (word.strip() for word in phrase.split())
-                    )
+                    (word, word_id) for word, word_id in current.extra
+                    if word_id not in version.index
                 ),
-                set()
             )
-        return self._terms[phrase]
 
-    def items(self):
-        return self._terms.itervalues()
+    def match(self, text):
+        """Returns a dict which maps usernames to the matched words.
+
+        Like before, words are searched as substrings of the text,
+        so "deploy" matches "redeployment". All words are found in
+        a single pass of the automaton, then only phrases, having
+        at least one of found words, are checked. Each user
+        receives words from all matched phrases, not only
+        from the last one.
+        """
+        version = self._version
+        index = version.index
+        terms = version.terms
+
+        automaton = version.automaton
+        if automaton is None:
+            # First automaton is built lazily, so loading
+            # of all terms costs only one build.
+            automaton = version.automaton = _build_automaton(index, self._words)
+
+        found = automaton.findall(text)
+        for word, word_id in version.extra:
+            if word in text:
+                found.add(word_id)
+
+        candidates = set()
+        for word_id in found:
+            candidates.update(index.get(word_id, ()))
+
+        words = self._words
+        usernames = self._usernames
+        result = {}
+        for phrase in candidates:
+            word_ids, user_ids = terms[phrase]
+            if all(word_id in found for word_id in word_ids):
+                matched = tuple(words[word_id] for word_id in word_ids)
+                for user_id in user_ids:
+                    _merge_words(result, usernames[user_id], matched)
+        return result
+
+
+class _Version(object):
+    """State of the SearchCache, which is never changed after publishing.
+
+    Only the first automaton is built lazily by the first reader.
+    """
+    __slots__ = ('terms', 'index', 'automaton', 'extra')
+
+    def __init__(self, terms, index, automaton=None, extra=()):
+        self.terms = terms # phrase to (word ids, user ids)
+        self.index = index # word id to phrases
+        self.automaton = automaton
+        self.extra = extra # (word, word id) missing in the automaton
+
+
+def _build_automaton(index, words):
+    return Automaton((words[word_id], word_id) for word_id in index.iterkeys())
+
+
+def _join(strings):
+    return u'\n'.join(strings).encode('utf-8')
+
+
+def _split(data):
+    if not data:
+        return []
+    return data.decode('utf-8').split(u'\n')
+
+
+def _unpack(data):
+    result = array('i')
+    result.fromstring(data)
+    return result
+
+
+class _Interned(object):
+    """Two-way mapping between strings and small integer ids."""
+
+    def __init__(self, values=()):
+        self.values = list(values)
+        self._ids = dict((value, idx) for idx, value in enumerate(self.values))
+
+    def id(self, value):
+        """Returns value's id, assigning a new one if needed."""
+        value_id = self._ids.get(value)
+        if value_id is None:
+            value_id = self._ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def get(self, value):
+        return self._ids.get(value)
+
+    def __getitem__(self, value_id):
+        return self.values[value_id]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class _Users(object):
+    """Read only set of usernames, backed by array of their ids."""
+    __slots__ = ('_ids', '_usernames')
+
+    def __init__(self, ids, usernames):
+        self._ids = ids
+        self._usernames = usernames
+
+    def __iter__(self):
+        usernames = self._usernames
+        return (usernames[user_id] for user_id in self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __nonzero__(self):
+        return len(self._ids) > 0
+
+    def __contains__(self, username):
+        user_id = self._usernames.get(username)
+        if user_id is None:
+            return False
+        idx = bisect_left(self._ids, user_id)
+        return idx < len(self._ids) and self._ids[idx] == user_id
+
+
+def _merge_words(result, username, words):
+    matched = result.setdefault(username, [])
+    matched.extend(w for w in words if w not in matched)
+
+
+class Automaton(object):
+    """Aho-Corasick automaton.
+
+    Finds all occurrences of the given words in a text
+    in one linear pass. Words are given as pairs (word, value)
+    and values of found words are returned.
+    """
+
+    def __init__(self, words):
+        goto = [{}]
+        output = [()]
+
+        for word, value in words:
+            state = 0
+            for char in word:
+                next = goto[state].get(char)
+                if next is None:
+                    next = len(goto)
+                    goto[state][char] = next
+                    goto.append({})
+                    output.append(())
+                state = next
+            output[state] = (value,)
+
+        # Failure links are calculated in breadth-first order,
+        # every state also inherits output of its failure state.
+        fail = [0] * len(goto)
+        queue = deque(goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, next in goto[state].iteritems():
+                queue.append(next)
+                f = fail[state]
+                while f and char not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(char, 0)
+                fail[next] = f
+                if output[f]:
+                    output[next] += output[f]
+
+        # All transitions are packed into one dict, keyed by
+        # state and character code, which takes several times
+        # less memory than a dict per state.
+        transitions = {}
+        for state, children in enumerate(goto):
+            for char, next in children.iteritems():
+                transitions[state << 21 | ord(char)] = next
+
+        self._transitions = transitions
+        self._fail = array('l', fail)
+        self._output = dict(
+            (state, values)
+            for state, values in enumerate(output)
+            if values
+        )
+
+    def findall(self, text):
+        """Returns a set of values of the words found in the text."""
+        transitions = self._transitions
+        fail = self._fail
+        output = self._output
+
+        found = set()
+        state = 0
+        for char in text:
+            code = ord(char)
+            next = transitions.get(state << 21 | code)
+            while next is None and state:
+                state = fail[state]
+                next = transitions.get(state << 21 | code)
+            state = next or 0
+            if state in output:
+                found.update(output[state])
+        return found
+
+
+class SearchPool(object):
+    """Pool of processes, each matching messages against its own
+    partition of the search phrases.
+
+    Every message is sent to all processes and their results
+    are merged. Processes are forked from the current one,
+    so they get already loaded search terms for free. Processes
+    are forked only once, reloaded terms are sent through their
+    task queues.
+
+    Every message gets a sequence number, and results of
+    previous messages, which came too late, are dropped.
+    """
+
+    def __init__(self, searches, processes, timeout=10):
+        self.size = processes
+        self.timeout = timeout
+        self._seq = 0
+        self._results = multiprocessing.Queue()
+        self._tasks = []
+        self._processes = []
+
+        for idx in xrange(processes):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target = _pool_worker,
+                name = 'search-%d' % idx,
+                args = (searches, idx, processes, tasks, self._results),
+            )
+            process.daemon = True
+            process.start()
+
+            self._tasks.append(tasks)
+            self._processes.append(process)
+
+    def _partition(self, phrase):
+        return self._tasks[_partition(phrase, len(self._tasks))]
+
+    def add(self, phrase, username):
+        self._partition(phrase).put(('add', phrase, username))
+
+    def discard(self, phrase, username):
+        self._partition(phrase).put(('discard', phrase, username))
+
+    def replace(self, searches):
+        """Replaces terms in all processes with the given ones.
+
+        Changes, sent after this call, are applied to new terms.
+        """
+        partitions = [[] for tasks in self._tasks]
+        for phrase, (words, users) in searches.iteritems():
+            partitions[_partition(phrase, len(partitions))].append(
+                (phrase, list(users))
+            )
+
+        for tasks, rows in zip(self._tasks, partitions):
+            tasks.put(('replace', rows))
+
+    def match(self, text):
+        """Same as SearchCache.match, but uses all processes.
+
+        Returns None if some process is dead or has not answered
+        in 'timeout' seconds, then pool should not be used anymore.
+        """
+        if not self.alive():
+            return None
+
+        self._seq += 1
+        seq = self._seq
+        for tasks in self._tasks:
+            tasks.put(('match', seq, text))
+
+        result = {}
+        waiting = set(xrange(len(self._tasks)))
+        deadline = time.time() + self.timeout
+        while waiting:
+            try:
+                reply_seq, idx, matched = self._results.get(
+                    timeout = max(0, min(1, deadline - time.time()))
+                )
+            except Empty:
+                if time.time() >= deadline or not self.alive():
+                    return None
+                continue
+
+            if reply_seq != seq or idx not in waiting:
+                continue
+            waiting.discard(idx)
+            for username, words in matched.iteritems():
+                _merge_words(result, username, words)
+        return result
+
+    def alive(self):
+        return all(process.is_alive() for process in self._processes)
+
+    def stop(self):
+        """Stops processes, when they processed all tasks."""
+        for tasks in self._tasks:
+            tasks.put(None)
+        for process in self._processes:
+            process.join()
+
+    def terminate(self):
+        """Stops processes right away, even stuck ones."""
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                # stopped process ignores SIGTERM until it is continued
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+
+def _partition(phrase, num_partitions):
+    if isinstance(phrase, unicode):
+        phrase = phrase.encode('utf-8')
+    return zlib.crc32(phrase) % num_partitions
+
+
+def _pool_worker(searches, idx, num_partitions, tasks, results):
+    log = logging.getLogger('search')
+    log.debug('Starting search process %d.' % idx)
+
+    partition = SearchCache()
+    partition.apply(
+        ('+', phrase, username)
+        for phrase, (words, users) in searches.iteritems()
+        if _partition(phrase, num_partitions) == idx
+        for username in users
+    )
+
+    # Whole cache, inherited from the parent, is not needed here.
+    global _searches
+    searches = _searches = None
+
+    while True:
+        task = tasks.get()
+
+        if task is None:
+            log.debug('Stopping search process %d.' % idx)
+            break
+
+        command = task[0]
+        if command == 'match':
+            try:
+                matched = partition.match(task[2])
+            except:
+                log.exception('Error during matching in process %d' % idx)
+                matched = {}
+            results.put((task[1], idx, matched))
+        elif command == 'add':
+            partition.add(task[1], task[2])
+        elif command == 'discard':
+            partition.discard(task[1], task[2])
+        elif command == 'replace':
+            log.debug('Replacing search terms in process %d.' % idx)
+            partition = SearchCache()
+            partition.apply(
+                ('+', phrase, username)
+                for phrase, users in task[1]
+                for username in users
+            )
+
+
+class EventQueue(Queue):
+    """Queue of events, waiting for search, with optional size limit.
+
+    When queue is full, 'policy' decides what to do:
+
+    * block - wait until search thread will take some events;
+    * drop_oldest - drop the oldest event from the queue;
+    * coalesce - drop the new event, if same text from the same
+      user is waiting already, otherwise drop the oldest one.
+
+    Items are stored along with the time, when they were enqueued.
+    Sentinel, which stops the search thread, is never dropped.
+    """
+    POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+    def __init__(self, maxsize=0, policy='block'):
+        Queue.__init__(self)
+        self.configure(maxsize, policy)
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def configure(self, maxsize, policy):
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown queue policy "%s".' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def put_event(self, event):
+        item = (time.time(), event)
+
+        if self.policy == 'block' or self.maxsize <= 0:
+            self.put(item)
+            return
+
+        with self.mutex:
+            if len(self.queue) >= self.maxsize:
+                if self.policy == 'coalesce' and self._has_same(event):
+                    self.coalesced += 1
+                    return
+                self._drop_oldest()
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _drop_oldest(self):
+        for idx, (enqueued_at, queued) in enumerate(self.queue):
+            if queued is not Sentinel:
+                del self.queue[idx]
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                return
+
+    def _has_same(self, event):
+        key = (event['from'].jid, event['body'])
+        for enqueued_at, queued in self.queue:
+            if queued is not Sentinel and \
+                    (queued['from'].jid, queued['body']) == key:
+                return True
+        return False
 
 
 _searches = SearchCache()
-_queue = Queue()
+_queue = EventQueue()
+_latency = Latency()
+_pool = None
+
+# Writers of the _searches should hold this lock.
+_lock = threading.Lock()
+
+# Snapshot of the _searches, and journal of changes made after it.
+_snapshot_path = None
+_journal = None
+
+# Search terms, reloaded from the database in background,
+# and changes, which should be applied to them before use.
+_reloaded = None
+_pending = None
+
+
+def _apply(op, word, username):
+    """Applies change to the search terms. Should be called with _lock held."""
+    if op == '+':
+        _searches.add(word, username)
+        if _pool is not None:
+            _pool.add(word, username)
+    else:
+        _searches.discard(word, username)
+        if _pool is not None:
+            _pool.discard(word, username)
+
+    if _journal is not None:
+        _journal.append(op, word, username)
+    if _pending is not None:
+        _pending.append((op, word, username))
 
 
 @db_session
@@ -55,8 +788,9 @@ def add_search(word, username, max_neightbours=20, session=None):
 
     log = logging.getLogger('search')
     log.debug('New search term "%s" for username "%s"' % (word, username))
-    neightbours = list(itertools.islice(_searches[word][1], max_neightbours))
-    _searches[word][1].add(username)
+    with _lock:
+        neightbours = list(itertools.islice(_searches[word][1], max_neightbours))
+        _apply('+', word, username)
 
     session.add(SearchTerm(word, username))
     return neightbours
@@ -68,7 +802,8 @@ def remove_search(word, username, session=None):
 
     log = logging.getLogger('search')
     log.debug('Removing search term "%s" for username "%s"' % (word, username))
-    _searches[word][1].discard(username)
+    with _lock:
+        _apply('-', word, username)
 
     try:
         term = session.query(SearchTerm).filter(SearchTerm.term == word).filter(
@@ -84,81 +819,286 @@ def process_message(event):
     if event.getType() == 'chat':
         log = logging.getLogger('search')
         log.debug('Adding text to the queue: "%s"' % event['body'])
-        _queue.put(event)
+        _queue.put_event(event)
 
 
 def stop():
+    """Stops search thread and processes.
+
+    Messages, queued before this call, will be processed.
+    """
     log = logging.getLogger('search')
     log.debug('Trying to stop search thread')
-    _queue.put(Sentinel)
+    _queue.put((time.time(), Sentinel))
+
+
+def stats():
+    """Returns search queue's gauges and counters.
+
+    'latency' is the time in seconds between message's
+    enqueuing and delivering of all notifications about it.
+    """
+    return dict(
+        depth = _queue.qsize(),
+        max_depth = _queue.max_depth,
+        maxsize = _queue.maxsize,
+        enqueued = _queue.enqueued,
+        dropped = _queue.dropped,
+        coalesced = _queue.coalesced,
+        latency = _latency.as_dict(),
+    )
+
+
+@db_session
+def _load_terms(session=None):
+    """Loads all search terms from the database."""
+    searches = SearchCache()
+    searches.apply(
+        ('+', term, username)
+        for term, username in session.query(SearchTerm.term, SearchTerm.username)
+    )
+    return searches
 
 
 @db_session
-def start(bot, session=None):
+def _count_terms(session=None):
+    return session.query(SearchTerm).count()
+
+
+def _load_snapshot(max_age):
+    """Loads search terms from the snapshot and replays the journal.
+
+    Returns True if snapshot is fresh enough, False if it
+    should be rebuilt and None if it could not be loaded.
+    """
+    global _searches
     log = logging.getLogger('search')
 
-    log.debug('Loading search terms.')
+    if not os.path.exists(_snapshot_path):
+        return None
+
+    try:
+        searches, meta = SearchCache.load(_snapshot_path)
+
+        changes = list(_journal.replay())
+        searches.apply(changes)
+        count = len(changes)
+    except Exception:
+        log.exception('Can\'t load snapshot "%s"' % _snapshot_path)
+        return None
 
-    count = 0
-    for term in session.query(SearchTerm).all():
-        _searches[term.term][1].add(term.username)
-        count += 1
-    log.debug('%d terms were loaded' % count)
+    _searches = searches
+    log.debug('%d terms were loaded from the snapshot, %d changes replayed.' % (
+        searches.count_rows(), count))
 
-    @db_session
-    def _process_event(event, session=None):
-        log.debug('Processing word "%s"' % event['body'])
+    if time.time() - meta.get('created_at', 0) > max_age:
+        log.debug('Snapshot is too old.')
+        return False
 
-        text = event['body']
-        from_user = get_user_by_jid(event['from'].jid, session)
+    if searches.count_rows() != _count_terms():
+        log.debug('Snapshot does not match the database.')
+        return False
 
-        body = 'Search: @%s says "%s"' % (from_user.username, text)
+    return True
 
-        num_recipients = 0
 
-        text = text.lower()
-        receivers = set()
-        terms = {} # user to terms hash
+def _save_snapshot():
+    log = logging.getLogger('search')
+    with _lock:
+        _searches.dump(_snapshot_path, created_at=time.time())
+        _journal.truncate()
+    log.debug('Snapshot "%s" was saved.' % _snapshot_path)
+
 
-        def all_in_text(words, text):
-            return all(map(lambda word: word in text, words))
+def _reload():
+    """Loads search terms from the database in background.
+
+    Search thread will switch to them, when they are ready.
+    """
+    global _reloaded, _pending
+    log = logging.getLogger('search')
+
+    with _lock:
+        _pending = []
+    try:
+        searches = _load_terms()
+    except Exception:
+        log.exception('Can\'t reload search terms')
+        with _lock:
+            _pending = None
+    else:
+        log.debug('%d terms were reloaded from the database.' % searches.count_rows())
+        # builds the automaton here, not in the search thread
+        searches.match(u'')
+        _reloaded = searches
 
-        for words, users in _searches.items():
-            if all_in_text(words, text):
-                receivers.update(users)
-                for user in users:
-                    terms[user] = words
 
-        for username in receivers:
-            user = get_user_by_username(username, session)
-            if user not in from_user.subscribers and \
-                    user != from_user:
-                payload = copy.deepcopy(event.payload)
+def _switch_to_reloaded():
+    global _searches, _reloaded, _pending
+
+    with _lock:
+        searches, _reloaded = _reloaded, None
+
+        if _pool is not None:
+            # Processes have their own copies of the old terms,
+            # and forking them again, when other threads are
+            # running, is not safe, so new terms are sent to them.
+            _pool.replace(searches)
+            for op, word, username in _pending:
+                if op == '+':
+                    _pool.add(word, username)
+                else:
+                    _pool.discard(word, username)
+
+        searches.apply(_pending)
+        _pending = None
+        _searches = searches
+
+    _save_snapshot()
+
+
+def _match(text):
+    global _pool
+
+    if _pool is not None:
+        result = _pool.match(text)
+        if result is not None:
+            return result
+
+        # Process, which is dead or stuck, would delay every message
+        # and its queue would grow, so the pool is dropped at once.
+        logging.getLogger('search').error(
+            'Search process has died or is stuck, '
+            'all messages will be matched in the search thread.'
+        )
+        with _lock:
+            pool, _pool = _pool, None
+        pool.terminate()
+
+    return _searches.match(text)
+
+
+@db_session
+def _process_event(bot, event, session=None):
+    """Sends search notifications about the message to all who wait them."""
+    log = logging.getLogger('search')
+    log.debug('Processing word "%s"' % event['body'])
 
-                for term in terms[username]:
-                    payload.add_node('searchTerm', term)
+    text = event['body']
+    from_user = get_user_by_jid(event['from'].jid, session)
 
-                num_recipients += 1
-                bot.send_message(user.jid, body, mfrom=bot.jid, mtype='chat', payload=payload)
+    body = 'Search: @%s says "%s"' % (from_user.username, text)
 
-        log.debug('This message was received by %s recipients.' % num_recipients)
+    num_recipients = 0
 
+    text = text.lower()
+    terms = _match(text) # user to terms hash
+
+    # Recipients are resolved once per message: sender's
+    # followers already got it, others are fetched in bulk.
+    terms.pop(from_user.username, None)
+    if not terms:
+        return
+
+    subscribers = GRAPH.subscribers(from_user.username, session)
+    recipients = GRAPH.jids(
+        (username for username in terms if username not in subscribers),
+        session
+    )
+
+    # Users who matched the same words get the same stanza.
+    groups = {}
+    for username, jid in recipients.iteritems():
+        groups.setdefault(tuple(terms[username]), []).append(jid)
+
+    for words, jids in groups.iteritems():
+        payload = event.payload.fork('searchTerm', words)
+        num_recipients += len(jids)
+        bot.send_bulk(jids, body, mfrom=bot.jid, mtype='chat', payload=payload)
+
+    log.debug('This message was received by %s recipients.' % num_recipients)
+
+
+@db_session
+def load(workers=0, snapshot_file=None, snapshot_max_age=86400, session=None):
+    """Loads search terms and starts search processes.
+
+    Should be called before any other thread is started, because
+    processes are forked here, and a thread, which holds a lock
+    (e.g. logging one) during the fork, would leave it locked forever
+    in the child.
+
+    If 'workers' is not zero, then messages are matched
+    by a pool of that many processes.
+
+    If 'snapshot_file' is given, then search terms are
+    loaded from it, and are reloaded from the database in
+    background only if snapshot is older than 'snapshot_max_age'
+    seconds or has different number of terms.
+    """
+    global _searches, _pool, _snapshot_path, _journal
+    log = logging.getLogger('search')
+
+    fresh = None
+    if snapshot_file:
+        _snapshot_path = os.path.expanduser(snapshot_file)
+        _journal = Journal(_snapshot_path + '.journal')
+        log.debug('Loading search terms from the snapshot.')
+        fresh = _load_snapshot(snapshot_max_age)
+
+    if fresh is None:
+        log.debug('Loading search terms.')
+        _searches = _load_terms(session=session)
+        log.debug('%d terms were loaded' % _searches.count_rows())
+        if _snapshot_path:
+            _save_snapshot()
+
+    if workers:
+        log.debug('Starting %d search processes.' % workers)
+        _pool = SearchPool(_searches, workers)
+
+    if fresh is not None and not fresh:
+        thread = threading.Thread(target = _reload)
+        thread.daemon = True
+        thread.start()
+
+
+def start(bot, queue_size=0, queue_policy='block'):
+    """Starts search thread, search terms should be loaded already.
+
+    If 'queue_size' is not zero, then no more than that number
+    of messages wait for search, and 'queue_policy' is applied
+    to others (see EventQueue).
+    """
+    log = logging.getLogger('search')
+
+    _queue.configure(queue_size, queue_policy)
 
     def _worker():
         log.debug('Starting search thread.')
         while True:
-            event = _queue.get()
+            enqueued_at, event = _queue.get()
+
+            if _reloaded is not None:
+                log.debug('Switching to reloaded search terms.')
+                _switch_to_reloaded()
 
             if event is Sentinel:
+                if _pool is not None:
+                    log.debug('Stopping search processes.')
+                    _pool.stop()
+                if _snapshot_path:
+                    _save_snapshot()
                 log.debug('Stopping search thread.')
                 break
 
             try:
-                _process_event(event)
+                _process_event(bot, event)
             except:
                 log.exception('Error during _process_event')
+            else:
+                _latency.add(time.time() - enqueued_at)
 
 
     thread = threading.Thread(target = _worker)
     thread.start()
-
@@ -9,7 +9,7 @@ import yaml
 
 
 from microblog import db
-from microblog.bot import Bot
+from microblog.bot import Bot, db_sessions_needed
 
 
 def dumpstacks(signal, frame):
@@ -52,17 +52,14 @@ def init(cfg):
     root.addHandler(handler)
 
     # Init database
-    db.init(cfg['database'])
+    db.init(
+        cfg['database'],
+        min_sessions = db_sessions_needed(**cfg['component'])
+    )
 
 
-def _start_bot():
+def _start_bot(bot):
     try:
-        if len(sys.argv) != 2:
-            print 'Usage: %s config.cfg' % sys.argv[0]
-            sys.exit(1)
-
-        cfg = yaml.load(open(sys.argv[1]).read())
-        bot = Bot(**cfg['component'])
         bot.start()
     except:
         logging.getLogger('init').exception('in bot thread')
@@ -90,7 +87,11 @@ def start_service():
     cfg = yaml.load(open(sys.argv[1]).read())
     init(cfg)
 
-    bot_thread = Thread(target = _start_bot)
+    # Bot is created before other threads,
+    # because it forks search processes.
+    bot = Bot(**cfg['component'])
+
+    bot_thread = Thread(target = _start_bot, args = (bot,))
     frontend_thread = Thread(target = _start_frontend)
 
     bot_thread.daemon = True
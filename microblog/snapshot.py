@@ -0,0 +1,126 @@
+"""
+On-disk snapshots of in-memory indexes.
+
+Snapshot is a file with a small JSON header, followed by named
+binary sections. It is read through mmap, so loading does not
+require to read the whole file into memory at once.
+
+Changes, made after the snapshot was written, are appended to
+a journal, which is replayed after the snapshot loading.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = 'CTSNAP1\n'
+
+
+class SnapshotError(RuntimeError): pass
+
+
+def write(path, sections, **meta):
+    """Writes a snapshot atomically.
+
+    'sections' is a list of pairs (name, data), where
+    data is a string. Keyword arguments are saved in the
+    header and available as Snapshot.meta.
+    """
+    offset = 0
+    table = []
+    for name, data in sections:
+        table.append((name, offset, len(data)))
+        offset += len(data)
+
+    header = json.dumps(dict(meta=meta, sections=table))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for name, data in sections:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class Snapshot(object):
+    """Memory mapped snapshot file."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+        try:
+            if self._mmap[:len(MAGIC)] != MAGIC:
+                raise SnapshotError('File "%s" is not a snapshot.' % path)
+
+            start = len(MAGIC)
+            header_len, = struct.unpack('<I', self._mmap[start:start + 4])
+            start += 4
+            header = json.loads(self._mmap[start:start + header_len])
+        except:
+            self.close()
+            raise
+
+        self.meta = header['meta']
+        self._data_start = start + header_len
+        self._sections = dict(
+            (name, (offset, length))
+            for name, offset, length in header['sections']
+        )
+
+    def __getitem__(self, name):
+        offset, length = self._sections[name]
+        start = self._data_start + offset
+        return self._mmap[start:start + length]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class Journal(object):
+    """Append-only log of changes, each change is a list of strings."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, *fields):
+        line = json.dumps(fields) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(line)
+            self._file.flush()
+
+    def replay(self):
+        """Yields changes in the order they were appended.
+
+        Partially written last line is ignored.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                yield json.loads(line)
+
+    def truncate(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(self.path, 'wb'):
+                pass
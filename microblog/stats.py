@@ -0,0 +1,41 @@
+"""
+In-process metrics, which could be polled by monitoring.
+"""
+import threading
+
+from collections import deque
+
+
+class Latency(object):
+    """Keeps last 'window' samples and calculates percentiles on them."""
+
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self.count += 1
+            self.total += value
+
+    def as_dict(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+            total = self.total
+
+        def percentile(p):
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+        return dict(
+            count = count,
+            avg = count and total / count or 0.0,
+            p50 = percentile(50),
+            p99 = percentile(99),
+            max = samples and samples[-1] or 0.0,
+        )
@@ -1,5 +1,8 @@
+from collections import OrderedDict
 from functools import wraps
 import logging
+import threading
+import time
 
 
 def _trace(func):
@@ -26,3 +29,66 @@ def trace_methods(cls):
         if callable(value):
             setattr(cls, key, _trace(value))
 
+
+
+class LRUCache(object):
+    """Thread-safe mapping with limited size and optional time to live.
+
+    When cache is full, least recently used item is evicted.
+    Items older than 'ttl' seconds are treated as missing.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None or \
+                    self.ttl is not None and item[0] < time.time():
+                self.misses += 1
+                return default
+
+            self._items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+
+        expires_at = self.ttl is not None and time.time() + self.ttl or None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires_at, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def as_dict(self):
+        return dict(
+            size = len(self._items),
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+        )
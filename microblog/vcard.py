@@ -0,0 +1,94 @@
+"""
+Parsed users' vCards.
+
+Raw vCards are stored in the database as XML. Values,
+needed on hot paths, are extracted once and cached
+until vCard's content is changed.
+"""
+import base64
+import hashlib
+import time
+
+from xml.etree import cElementTree as ET
+
+from microblog.models import VCard
+from microblog.utils import LRUCache
+
+# username -> (checked until, vCard's created_at, VCardInfo or None)
+_vcards = LRUCache(size=10000)
+_ttl = 300
+
+
+class VCardInfo(object):
+    """Values from the vCard, already decoded."""
+
+    __slots__ = (
+        'first_name', 'nickname',
+        'photo', 'photo_type', 'avatar_hash',
+    )
+
+    def __init__(self, xml):
+        ns = xml.tag[:xml.tag.rfind('}') + 1]
+
+        self.first_name = xml.findtext(ns + 'FN') or None
+        self.nickname = xml.findtext(ns + 'NICKNAME') or None
+
+        binval = xml.findtext('%sPHOTO/%sBINVAL' % (ns, ns))
+        if binval:
+            self.photo = base64.standard_b64decode(binval)
+            self.photo_type = xml.findtext('%sPHOTO/%sTYPE' % (ns, ns)) or 'image/jpeg'
+            self.avatar_hash = hashlib.sha1(self.photo).hexdigest()
+        else:
+            self.photo = None
+            self.photo_type = None
+            self.avatar_hash = ''
+
+
+def configure(size, ttl):
+    """Changes size of the cache and how long vCards are used unchecked."""
+    global _ttl
+    _vcards.size = size
+    _ttl = ttl
+    _vcards.clear()
+
+
+def get(username, session):
+    """Returns VCardInfo for user's vCard or None if there is no vCard.
+
+    Cached vCard is returned without any queries for 'ttl' seconds,
+    then only vCard's created_at is read, and raw vCard is loaded
+    and parsed again only if created_at was changed. The same
+    VCardInfo is returned, until vCard is changed.
+    """
+    now = time.time()
+    cached = _vcards.get(username)
+    if cached is not None and cached[0] > now:
+        return cached[2]
+
+    row = session.query(VCard.created_at).filter(
+        VCard.username == username
+    ).first()
+
+    if row is None:
+        created_at = info = None
+    else:
+        created_at = row[0]
+        if cached is not None and cached[2] is not None and \
+                created_at is not None and cached[1] == created_at:
+            info = cached[2]
+        else:
+            raw = session.query(VCard.vcard).filter(
+                VCard.username == username
+            ).scalar()
+            info = VCardInfo(ET.fromstring(raw.encode('utf-8')))
+
+    _vcards.set(username, (now + _ttl, created_at, info))
+    return info
+
+
+def invalidate(username):
+    _vcards.pop(username)
+
+
+def stats():
+    return _vcards.as_dict()
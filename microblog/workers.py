@@ -0,0 +1,97 @@
+"""
+Thread pools for the bot's background work.
+"""
+import logging
+import threading
+
+from Queue import Queue
+
+
+class Task(object):
+    """Function call, which could be waited for."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+        except Exception, e:
+            self.exception = e
+            raise
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Waits until task is done, returns True if it is."""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+
+class KeyedPool(object):
+    """Pool of threads, where each thread has its own queue.
+
+    Tasks with the same key always go to the same thread, so they
+    are executed one by one, in the order they were submitted,
+    while tasks with different keys are executed in parallel.
+
+    Pool of zero size executes tasks right in the 'submit' call.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.log = logging.getLogger(name)
+        self._queues = []
+        self._threads = []
+
+        for idx in xrange(size):
+            queue = Queue()
+            thread = threading.Thread(
+                target = self._worker,
+                name = '%s-%d' % (name, idx),
+                args = (queue,),
+            )
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+            self._threads.append(thread)
+
+    def __len__(self):
+        return len(self._threads)
+
+    def submit(self, key, func, *args, **kwargs):
+        task = Task(func, args, kwargs)
+        if self._queues:
+            self._queues[hash(key) % len(self._queues)].put(task)
+        else:
+            self._run(task)
+        return task
+
+    def qsize(self):
+        """Returns number of tasks, waiting in all queues."""
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stop(self):
+        """Stops threads, when they have done all submitted tasks."""
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                break
+            self._run(task)
+
+    def _run(self, task):
+        try:
+            task.run()
+        except Exception:
+            self.log.exception('Error in the task %r' % task.func)
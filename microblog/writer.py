@@ -0,0 +1,159 @@
+"""
+Group commit for tweets.
+"""
+import datetime
+import logging
+import threading
+import time
+
+from microblog.db import Session
+from microblog.models import Tweet
+from microblog.stats import Latency
+
+
+class _Write(object):
+    def __init__(self, row):
+        self.row = row
+        self.exception = None
+        self.done = threading.Event()
+
+
+class TweetWriter(object):
+    """Saves tweets from many threads in shared transactions.
+
+    Rows are collected until there are 'max_rows' of them or
+    the oldest one waits for 'max_delay' seconds, then they are
+    inserted with one executemany, which MySQLdb sends as a
+    multi-row INSERT, and committed. 'write' returns only after
+    the commit, so a post is never acknowledged before it is durable.
+
+    Every 'write' blocks the calling thread, so a batch is never
+    larger than the number of threads, which write concurrently,
+    and 'max_rows' should not exceed it, or every batch would
+    wait for the whole 'max_delay'.
+
+    Writer with zero 'max_rows' saves tweets right in the
+    'write' call. Tweet is committed on its own connection,
+    so the caller's session is not committed and objects,
+    loaded in it, are not expired.
+    """
+
+    def __init__(self, max_rows=0, max_delay=0.005):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.log = logging.getLogger('writer')
+
+        self.flush_size = Latency()
+        self.flush_latency = Latency()
+        self.write_latency = Latency()
+
+        self._pending = []
+        self._first_at = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+        if max_rows > 0:
+            self._thread = threading.Thread(target=self._worker, name='writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, username, text, session):
+        """Saves a tweet, raises an exception if it was not saved."""
+        started = time.time()
+
+        row = dict(
+            username = username,
+            text = text,
+            created_at = datetime.datetime.utcnow(),
+        )
+
+        if self._thread is None:
+            # executed without a transaction, so it is committed at once
+            session.get_bind(Tweet.__mapper__).execute(
+                Tweet.__table__.insert(), row
+            )
+            latency = time.time() - started
+            self.flush_size.add(1)
+            self.flush_latency.add(latency)
+            self.write_latency.add(latency)
+            return
+
+        write = _Write(row)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Tweet writer was stopped.')
+            if not self._pending:
+                self._first_at = started
+            self._pending.append(write)
+            self._cond.notify()
+
+        write.done.wait()
+        self.write_latency.add(time.time() - started)
+        if write.exception is not None:
+            raise write.exception
+
+    def stop(self):
+        """Flushes all pending tweets and stops the writer's thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return dict(
+            pending = pending,
+            flush_size = self.flush_size.as_dict(),
+            flush_latency = self.flush_latency.as_dict(),
+            write_latency = self.write_latency.as_dict(),
+        )
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+
+                if not self._pending:
+                    return
+
+                while len(self._pending) < self.max_rows and not self._stopped:
+                    timeout = self._first_at + self.max_delay - time.time()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+
+                batch = self._pending[:self.max_rows]
+                del self._pending[:self.max_rows]
+                # rest of rows is already late
+                self._first_at = 0
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.time()
+        exception = None
+
+        session = Session()
+        try:
+            session.execute(
+                Tweet.__table__.insert(),
+                [write.row for write in batch]
+            )
+            session.commit()
+        except Exception, e:
+            self.log.exception('Can\'t save %d tweets.' % len(batch))
+            session.rollback()
+            exception = e
+        finally:
+            session.close()
+
+        self.flush_size.add(len(batch))
+        self.flush_latency.add(time.time() - started)
+
+        for write in batch:
+            write.exception = exception
+            write.done.set()
@@ -26,3 +26,6 @@ CREATE TABLE tweets(
 ) ENGINE = InnoDB, CHARSET=utf8;
 
 CREATE INDEX by_user ON tweets (username);
+
+-- digest mode, window in minutes, 0 means that digests are off
+ALTER TABLE users ADD digest INTEGER NOT NULL DEFAULT 0;